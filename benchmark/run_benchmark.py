@@ -0,0 +1,301 @@
+import os
+import os.path as osp
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pydicom
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from run import unzip_case, register
+from utils.annotation_io import read_liver_annotation, \
+    read_spleen_annotation, read_organ_annotation, \
+    read_liver_segments_annotation, read_vessel_annotation, \
+    read_lesion_annotation
+from utils.database import PatientDatabase
+from utils.dicom_io import read_dicom_list, read_dicom_series, \
+    parse_dicom_list
+from utils.metrics import read_rss, reset_peak_rss
+from benchmark.synthesize import transfer_syntaxes, annotation_names, \
+    make_dataset, make_database_json
+
+annotation_readers = {
+    'liver': read_liver_annotation,
+    'spleen': read_spleen_annotation,
+    'organ': read_organ_annotation,
+    'liver_segments': read_liver_segments_annotation,
+    'vessel': read_vessel_annotation,
+    'lesion': read_lesion_annotation,
+}
+
+
+def get_tree_bytes(path: str) -> int:
+    return sum(
+        osp.getsize(osp.join(root, file))
+        for root, _, files in os.walk(path) for file in files)
+
+
+def measure(
+        name: str,
+        func: Callable,
+        items: int = 1,
+        size: int = 0,
+        repeat: int = 1,
+        setup: Optional[Callable] = None
+) -> Dict:
+    '''
+    Time func, best of repeat runs
+    :param items: number of items (cases, slices, queries) processed by func
+    :param size: bytes processed by func
+    :param setup: called before each run, not timed
+    :return: {'name', 'seconds', 'items', 'items_per_second',
+        'bytes_per_second', 'peak_rss', 'rss_increase'}
+    '''
+    seconds = []
+    reset_peak_rss()
+    rss = read_rss('VmRSS')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    peak_rss = read_rss()
+    best = min(seconds)
+    return {
+        'name': name,
+        'seconds': best,
+        'items': items,
+        'items_per_second': items / best if best > 0 else None,
+        'bytes_per_second': size / best if size and best > 0 else None,
+        'peak_rss': peak_rss,
+        'rss_increase':
+            None if peak_rss is None or rss is None else peak_rss - rss,
+    }
+
+
+def benchmark_cases(args: argparse.Namespace, work_dir: str) -> List[Dict]:
+    results = []
+    data_dir = osp.join(work_dir, 'data')
+    tmp_dir = osp.join(work_dir, 'tmp')
+    case_paths = make_dataset(
+        data_dir, args.cases,
+        slices=args.slices, rows=args.rows, columns=args.columns,
+        transfer_syntax=args.transfer_syntax,
+        annotations=args.annotations)
+    zip_size = sum(osp.getsize(path) for path in case_paths)
+
+    def unzip_all():
+        for path in case_paths:
+            unzip_case(path, tmp_dir)
+
+    results.append(measure(
+        'unzip_case', unzip_all, len(case_paths), zip_size, args.repeat,
+        lambda: shutil.rmtree(tmp_dir, ignore_errors=True)))
+    case_dirs = [
+        osp.join(tmp_dir, osp.splitext(osp.basename(path))[0])
+        for path in case_paths]
+    slices_dirs = [osp.join(case_dir, 'slices') for case_dir in case_dirs]
+    slice_count = args.cases * args.slices
+    slices_size = sum(get_tree_bytes(path) for path in slices_dirs)
+
+    dicom_lists = []
+
+    def read_all():
+        dicom_lists[:] = [read_dicom_list(path) for path in slices_dirs]
+
+    results.append(measure(
+        'read_dicom_list', read_all, slice_count, slices_size, args.repeat))
+
+    def parse_all():
+        for dicom_list in dicom_lists:
+            parse_dicom_list(dicom_list, ['spacing', 'acquisition_datetime'])
+
+    results.append(measure(
+        'parse_dicom_list', parse_all, slice_count, 0, args.repeat))
+    dicom_lists.clear()
+
+    results.append(measure(
+        'read_dicom_series',
+        lambda: [read_dicom_series(path) for path in slices_dirs],
+        slice_count, 0, args.repeat))
+
+    ann_dirs = [osp.join(case_dir, 'annotation') for case_dir in case_dirs]
+    ann_size = sum(get_tree_bytes(path) for path in ann_dirs)
+    for name, read_annotation in annotation_readers.items():
+        results.append(measure(
+            name.join(('read_', '_annotation')),
+            lambda: [read_annotation(path) for path in ann_dirs],
+            args.cases, ann_size, args.repeat))
+
+    def register_all():
+        database = PatientDatabase(osp.join(work_dir, 'register_database'))
+        for path in slices_dirs:
+            register(database, slices_dir=path, mvd='MVD16')
+        database.close()
+
+    results.append(measure(
+        'register', register_all, args.cases, 0, args.repeat,
+        lambda: shutil.rmtree(
+            osp.join(work_dir, 'register_database'), ignore_errors=True)))
+
+    return results
+
+
+def benchmark_database(args: argparse.Namespace, work_dir: str) -> List[Dict]:
+    results = []
+    database_dir = osp.join(work_dir, 'database')
+    counts = make_database_json(database_dir, args.db_cases)
+    patient_infos = json.load(
+        open(osp.join(database_dir, 'patient_infos.json')))
+    case_ids = list(json.load(
+        open(osp.join(database_dir, 'case_progress.json'))))
+
+    def remove_sqlite():
+        for file in os.listdir(database_dir):
+            if file.startswith('database.sqlite'):
+                os.remove(osp.join(database_dir, file))
+
+    def migrate():
+        PatientDatabase(database_dir).close()
+
+    results.append(measure(
+        'database_migrate', migrate, counts['cases'], 0, args.repeat,
+        remove_sqlite))
+    results.append(measure(
+        'database_load', migrate, counts['cases'], 0, args.repeat))
+
+    database = PatientDatabase(database_dir)
+    rng = np.random.RandomState(0)
+    ops = min(args.db_ops, len(case_ids))
+    sample = [case_ids[i] for i in rng.choice(len(case_ids), ops, False)]
+    results.append(measure(
+        'get_local_id',
+        lambda: [database.get_local_id(case_id) for case_id in sample],
+        ops))
+
+    ### half a new phase of a known study, half a new patient
+    patient_ids = list(patient_infos)
+    queries = []
+    for i in range(ops):
+        if i % 2 == 0:
+            patient_id = patient_ids[rng.randint(len(patient_ids))]
+            study_datetime = patient_infos[patient_id][0]['study_datetime'][0]
+            study_datetime = study_datetime[:-2] + '59'
+        else:
+            patient_id = f'NEW{i:08d}'
+            study_datetime = '20230101120000'
+        queries.append((patient_id, study_datetime))
+    results.append(measure(
+        'get_local_id_by_meta_info',
+        lambda: [
+            database.get_local_id_by_meta_info(
+                patient_id, study_datetime, 'MVD16')
+            for patient_id, study_datetime in queries],
+        ops))
+
+    def update_progress():
+        for case_id in sample:
+            database.update_case_progress(case_id, status='done')
+        database.commit()
+
+    results.append(measure('update_case_progress', update_progress, ops))
+    results.append(measure(
+        'export_json', database.export_json, counts['cases']))
+    database.close()
+
+    for result in results:
+        result.update(counts)
+    return results
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=osp.dirname(osp.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Time the stages of the pipeline on synthetic data, '
+                    'report as json.')
+    parser.add_argument('--work-dir', default=None,
+                        help='Directory of the synthetic data, a temporary '
+                             'directory removed at the end by default.')
+    parser.add_argument('--cases', type=int, default=4,
+                        help='Number of synthetic cases.')
+    parser.add_argument('--slices', type=int, default=64,
+                        help='Slices of a case.')
+    parser.add_argument('--rows', type=int, default=512,
+                        help='Rows of a slice.')
+    parser.add_argument('--columns', type=int, default=512,
+                        help='Columns of a slice.')
+    parser.add_argument('--transfer-syntax', default='explicit',
+                        choices=tuple(transfer_syntaxes),
+                        help='Transfer syntax of the slices.')
+    parser.add_argument('--annotations',
+                        default='liver,spleen,hv,pv,ivc,bz,bzyw,1,2,3',
+                        help='Comma separated annotations of a case, among '
+                             + ','.join(annotation_names))
+    parser.add_argument('--db-cases', type=int, default=10000,
+                        help='Number of cases of the synthetic database.')
+    parser.add_argument('--db-ops', type=int, default=1000,
+                        help='Number of each database operation timed.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs of each stage, the best is reported.')
+    parser.add_argument('--skip-cases', action='store_true',
+                        help='Only benchmark the database.')
+    parser.add_argument('--skip-database', action='store_true',
+                        help='Only benchmark the cases.')
+    parser.add_argument('--output', default=None,
+                        help='Json file to write, stdout by default.')
+    args = parser.parse_args()
+    args.annotations = [
+        name for name in args.annotations.split(',') if name]
+    return args
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='rearange_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = []
+        if not args.skip_cases:
+            results.extend(benchmark_cases(args, work_dir))
+        if not args.skip_database:
+            results.extend(benchmark_database(args, work_dir))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'commit': get_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pydicom': pydicom.__version__,
+        'cpus': os.cpu_count(),
+        'config': {
+            key: value for key, value in vars(args).items()
+            if key not in ('work_dir', 'output')},
+        'results': results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,225 @@
+import io
+import os
+import os.path as osp
+import json
+import datetime
+import zipfile
+from typing import Dict, Iterable, List
+
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, \
+    ImplicitVRLittleEndian, ExplicitVRBigEndian, \
+    DeflatedExplicitVRLittleEndian, RLELossless
+
+transfer_syntaxes = {
+    'explicit': ExplicitVRLittleEndian,
+    'implicit': ImplicitVRLittleEndian,
+    'big': ExplicitVRBigEndian,
+    'deflated': DeflatedExplicitVRLittleEndian,
+    'rle': RLELossless,
+}
+### annotation zips of a case, as found in cases of the middle platform
+annotation_names = (
+    'liver', 'spleen', 'hv', 'pv', 'ivc', 'nb', 'yw', 'bz', 'bzyw',
+    '1', '2', '3', '4', '5', '6', '7', '8')
+
+
+def make_slice(
+        pixels: np.ndarray,
+        location: float,
+        patient_id: str,
+        series_instance_uid: str,
+        study_datetime: str,
+        transfer_syntax: str = 'explicit',
+        instance_number: int = 1
+) -> bytes:
+    '''
+    :param pixels: 2d int16 or uint8 slice
+    :param study_datetime: %Y%m%d%H%M%S
+    :return: the dicom file
+    '''
+    uid = transfer_syntaxes[transfer_syntax]
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian \
+        if transfer_syntax == 'rle' else uid
+    dicom = FileDataset(None, {}, file_meta=meta, preamble=b'\0' * 128)
+    dicom.is_little_endian = uid != ExplicitVRBigEndian
+    dicom.is_implicit_VR = uid == ImplicitVRLittleEndian
+
+    dicom.SOPClassUID = meta.MediaStorageSOPClassUID
+    dicom.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    dicom.PatientID = patient_id
+    dicom.StudyInstanceUID = generate_uid(entropy_srcs=[patient_id])
+    dicom.SeriesInstanceUID = series_instance_uid
+    dicom.StudyDate = study_datetime[:8]
+    dicom.StudyTime = study_datetime[8:]
+    dicom.AcquisitionDate = study_datetime[:8]
+    dicom.AcquisitionTime = study_datetime[8:]
+    dicom.Manufacturer = 'SYNTHETIC Scanner'
+    dicom.SeriesDescription = 'synthetic'
+    dicom.InstanceNumber = instance_number
+    dicom.ImagePositionPatient = [0., 0., location]
+    dicom.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dicom.PixelSpacing = [0.7, 0.7]
+    dicom.Rows, dicom.Columns = pixels.shape
+    dicom.SamplesPerPixel = 1
+    dicom.PhotometricInterpretation = 'MONOCHROME2'
+    dicom.BitsAllocated = dicom.BitsStored = pixels.dtype.itemsize * 8
+    dicom.HighBit = dicom.BitsStored - 1
+    dicom.PixelRepresentation = int(pixels.dtype.kind == 'i')
+    if transfer_syntax == 'rle':
+        dicom.compress(RLELossless, pixels)
+    else:
+        dicom.PixelData = pixels.astype(
+            pixels.dtype.newbyteorder('>' if uid == ExplicitVRBigEndian
+                                      else '<')).tobytes()
+
+    buffer = io.BytesIO()
+    dicom.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
+
+
+def write_series(
+        zip_file: zipfile.ZipFile,
+        directory: str,
+        volume: np.ndarray,
+        patient_id: str,
+        study_datetime: str,
+        transfer_syntax: str,
+        rng: np.random.RandomState
+):
+    '''
+    write the slices of a volume in a random order, as the file order of
+    exported series is not the slice order
+    '''
+    series_instance_uid = generate_uid()
+    for z in rng.permutation(len(volume)):
+        zip_file.writestr(
+            f'{directory}/IM{z:04d}',
+            make_slice(
+                volume[z], -2.5 * z, patient_id, series_instance_uid,
+                study_datetime, transfer_syntax, int(z) + 1))
+
+
+def make_case(
+        path: str,
+        slices: int = 64,
+        rows: int = 512,
+        columns: int = 512,
+        transfer_syntax: str = 'explicit',
+        annotations: Iterable[str] = ('liver', 'spleen', 'hv', 'pv', 'bz'),
+        patient_id: str = 'P0',
+        study_datetime: str = '20210422130746',
+        seed: int = 0
+):
+    '''
+    Write a DI_*.zip case: case_id/slices/ and a nested zip of mask slices
+    per annotation in case_id/annotation/
+    :param annotations: names among annotation_names
+    '''
+    rng = np.random.RandomState(seed)
+    case_id = osp.splitext(osp.basename(path))[0]
+    volume = rng.randint(-1024, 2048, (slices, rows, columns)).astype(np.int16)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        write_series(
+            zip_file, f'{case_id}/slices', volume, patient_id,
+            study_datetime, transfer_syntax, rng)
+        for name in annotations:
+            ### a box of foreground, most voxels of masks are background
+            mask = np.zeros((slices, rows, columns), np.uint8)
+            z, y, x = (rng.randint(0, size // 2 + 1)
+                       for size in (slices, rows, columns))
+            mask[z:z + slices // 3, y:y + rows // 4, x:x + columns // 4] = 1
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(
+                    buffer, 'w', zipfile.ZIP_DEFLATED) as nested_zip:
+                write_series(
+                    nested_zip, name, mask, patient_id, study_datetime,
+                    transfer_syntax, rng)
+            zip_file.writestr(
+                f'{case_id}/annotation/{name}.zip', buffer.getvalue())
+
+
+def make_dataset(
+        data_dir: str,
+        cases: int,
+        mvd: str = 'MVD16',
+        category: str = 'portal',
+        **case_kwargs
+) -> List[str]:
+    '''
+    Write cases as downloaded from the middle platform, in
+    data_dir/<anything>_<mvd>_<category>/DI_*.zip
+    :param case_kwargs: passed to make_case
+    :return: paths of the cases
+    '''
+    case_dir = osp.join(data_dir, f'synthetic_{mvd}_{category}')
+    os.makedirs(case_dir, exist_ok=True)
+    paths = []
+    for i in range(cases):
+        path = osp.join(case_dir, f'DI_SYN{i:06d}.zip')
+        make_case(
+            path, patient_id=f'P{i:06d}', seed=i, **case_kwargs)
+        paths.append(path)
+    return paths
+
+
+def make_database_json(
+        database_dir: str,
+        cases: int,
+        mvds: Iterable[str] = ('MVD16', ),
+        max_studies: int = 3,
+        seed: int = 0
+) -> Dict[str, int]:
+    '''
+    Write patient_infos.json and case_progress.json of a database of about
+    `cases` cases, patients have 1 to max_studies studies
+    :return: {'patients', 'studies', 'cases'}
+    '''
+    rng = np.random.RandomState(seed)
+    mvds = list(mvds)
+    start = datetime.datetime(2018, 1, 1)
+    patient_infos, case_progress = {}, {}
+    next_numbers = {mvd: 0 for mvd in mvds}
+    patient_count, study_count = 0, 0
+    while len(case_progress) < cases:
+        patient_id = f'SYN{patient_count:08d}'
+        patient_count += 1
+        studies = []
+        study_time = start + datetime.timedelta(
+            minutes=int(rng.randint(0, 3 * 365 * 24 * 60)))
+        for _ in range(rng.randint(1, max_studies + 1)):
+            mvd = mvds[rng.randint(len(mvds))]
+            local_id = f'PA-{int(mvd[3:]):0>2}-{next_numbers[mvd]:0>4}'
+            next_numbers[mvd] += 1
+            ### phases of a study, a few minutes apart
+            datetimes = [
+                (study_time + datetime.timedelta(minutes=5 * phase)
+                 ).strftime('%Y%m%d%H%M%S')
+                for phase in range(rng.randint(1, 4))]
+            studies.append(
+                {'study_datetime': datetimes, 'local_id': local_id})
+            for _ in datetimes:
+                case_progress[f'DI_SYN{len(case_progress):08d}'] = {
+                    'LocalID': local_id,
+                    'Status': 'done',
+                    'LatestModificationDatetime': str(study_time)}
+            study_count += 1
+            study_time += datetime.timedelta(
+                days=int(rng.randint(1, 180)))
+        patient_infos[patient_id] = studies
+
+    os.makedirs(database_dir, exist_ok=True)
+    with open(osp.join(database_dir, 'patient_infos.json'), 'w') as f:
+        json.dump(patient_infos, f)
+    with open(osp.join(database_dir, 'case_progress.json'), 'w') as f:
+        json.dump(case_progress, f)
+
+    return {
+        'patients': patient_count,
+        'studies': study_count,
+        'cases': len(case_progress)}
+
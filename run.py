@@ -1,3 +1,5 @@
+import errno
+import hashlib
 import os
 import os.path as osp
 import shutil
@@ -5,13 +7,30 @@ import sys
 import argparse
 import logging
 import datetime
+import multiprocessing
+import queue
+import threading
 import json
-from multiprocessing import Pool, Manager
-from typing import Dict, Optional
+import uuid
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import Future, ProcessPoolExecutor, \
+    ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from typing import Callable, Dict, Generator, Iterable, Optional, Tuple
 
 from utils.annotation_io import *
 from utils.dicom_io import *
-from utils.database import PatientDatabase
+from utils.database import PatientDatabase, DatabaseManager
+from utils.header_index import HeaderIndex
+from utils.metrics import init_metrics, measure, call_measured, \
+    read_metrics, summarize_metrics, log_summary
+from utils.scheduler import Scheduler, not_ready
+from utils.volume_io import volume_formats, zvol_codecs, open_volume, \
+    close_volume
+
+### used by the main process and the pool workers alike, see init_logging
+logger = logging.getLogger('rearange')
 
 annotation_zips = {
     # organ segmentation
@@ -31,6 +50,26 @@ annotation_zips = {
     'fqbzyw.zip'  #废弃疑问病灶
 }
 
+def parse_size(size: str) -> int:
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+### annotations read by each preprocess stage, for the case manifest
+stage_annotations = {
+    'organ': ('liver', 'spleen'),
+    'vessel': ('hv', 'pv', 'ivc', 'nb', 'yw'),
+    'lesion': ('bz', 'bzyw', 'fqbz', 'fqbzyw'),
+}
+preprocess_stages = ('raw', 'organ', 'vessel', 'lesion')
+### levels of chatty modules, unless set by --log-levels
+default_log_levels = {'pydicom': 'WARNING'}
+### memory held by a slice of a series read, its header table row and path
+header_size = header_table_dtype.itemsize + 2 ** 8
+
 def get_parser() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description='Pipeline to rearange data downloaded '
@@ -41,9 +80,68 @@ def get_parser() -> argparse.Namespace:
     parser.add_argument('--output-dir', help='Directory to output.')
     parser.add_argument('--cpus', type=int, default=8,
                         help='Number of CPU cores.')
+    parser.add_argument('--slice-threads', type=int, default=1,
+                        help='Threads reading slices of a series in '
+                             'each preprocess worker.')
+    parser.add_argument('--direct-slices', action='store_true',
+                        help='Extract slices from zips straight to '
+                             '--output-dir instead of through --tmp-dir.')
+    parser.add_argument('--tmp-budget', type=parse_size, default=0,
+                        help='Hold back unzipping while --tmp-dir uses more '
+                             'than this, e.g. 200G. Unlimited by default.')
+    ### sparse is for label volumes, see --sparse-annotations
+    parser.add_argument('--output-format',
+                        choices=tuple(
+                            volume_format for volume_format in volume_formats
+                            if volume_format != 'sparse'),
+                        default='npy',
+                        help='Format of the volumes saved: .npy, .zvol '
+                             '(compressed chunks of z-slices) or .nii.gz.')
+    parser.add_argument('--codec', choices=tuple(zvol_codecs),
+                        default='zlib',
+                        help='Compression of .zvol volumes.')
+    parser.add_argument('--slab', type=int, default=1,
+                        help='Number of z-slices in a chunk of .zvol '
+                             'volumes.')
+    parser.add_argument('--sparse-annotations', action='store_true',
+                        help='Save annotation volumes as .sparse.npz, the '
+                             'bounding box and runs of their labels.')
+    parser.add_argument('--index-headers', action='store_true',
+                        help='Update the header index of the slices in '
+                             '--output-dir once cases are rearanged.')
+    parser.add_argument('--mem-budget', type=parse_size, default=0,
+                        help='Hold back preprocessing while the estimated '
+                             'memory of cases being preprocessed is more '
+                             'than this, e.g. 64G. Unlimited by default.')
+    parser.add_argument('--scan-threads', type=int, default=8,
+                        help='Threads walking --data-dir for cases.')
+    parser.add_argument('--max-in-flight', type=int, default=0,
+                        help='Max number of cases in the pipeline at a '
+                             'time, 2 per worker by default.')
+    parser.add_argument('--log-level', default='INFO', type=str.upper,
+                        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help='Level of the log.')
+    parser.add_argument('--log-levels', default='',
+                        help='Levels of modules, e.g. '
+                             'pydicom=DEBUG,utils.scheduler=DEBUG. pydicom '
+                             'logs warnings and above by default.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Dump cProfile stats of every worker in '
+                             '--output-dir/profile.')
     parser.add_argument('--overwrite', action='store_true',
                         help='Overwrite existed files all the time.')
+    parser.add_argument('--read-zip', action='store_true',
+                        help='Read cases from zips directly, '
+                             'without unzipping to --tmp-dir.')
     args = parser.parse_args()
+    if args.slab < 1:
+        parser.error('--slab must be at least 1.')
+    for name, level in get_log_levels(args).items():
+        ### names of levels map to numbers
+        if not isinstance(logging.getLevelName(level), int):
+            parser.error(
+                f'argument --log-levels: invalid level {level!r} of '
+                f'{name!r}.')
 
     if not osp.isdir(args.data_dir):
         raise NotADirectoryError(
@@ -55,29 +153,72 @@ def get_parser() -> argparse.Namespace:
     return args
 
 
-def get_logger(args: argparse.Namespace) -> logging.Logger:
-    logging.basicConfig(
-        level=logging.DEBUG,
-        handlers=[
-            logging.StreamHandler(sys.stdout),
-            logging.FileHandler(
-                osp.join(args.output_dir, 'rearange.log'),
-                mode='w'
-            )])
-    logger = logging.getLogger()
+def get_log_levels(args: argparse.Namespace) -> Dict[str, str]:
+    '''
+    :return: logger name -> level, '' for the root logger
+    '''
+    log_levels = dict(default_log_levels)
+    log_levels[''] = args.log_level
+    for item in args.log_levels.split(','):
+        if item.strip():
+            name, _, level = item.partition('=')
+            log_levels[name.strip()] = level.strip().upper()
+    return log_levels
+
+
+def init_logging(
+        log_queue: multiprocessing.Queue,
+        log_levels: Dict[str, str]
+):
+    '''
+    Send the records of this process to log_queue, records under the level
+    of their logger are dropped before being formatted
+    '''
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    for name, level in log_levels.items():
+        logging.getLogger(name or None).setLevel(level)
+
 
-    return logger
+def get_logger(
+        args: argparse.Namespace,
+        log_queue: multiprocessing.Queue
+) -> QueueListener:
+    '''
+    Records of the main process and of workers go through log_queue to one
+    listener thread, the only one writing to stdout and rearange.log
+    '''
+    formatter = logging.Formatter(
+        '%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s')
+    handlers = [
+        logging.StreamHandler(sys.stdout),
+        logging.FileHandler(
+            osp.join(args.output_dir, 'rearange.log'),
+            mode='w')]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    init_logging(log_queue, get_log_levels(args))
+    listener = QueueListener(log_queue, *handlers)
+    listener.start()
+
+    return listener
 
 
 def unzip_case(
         source_file: str,
-        destination_dir: str
+        destination_dir: str,
+        skip_slices: bool = False
 ):
     case_id = osp.splitext(osp.basename(source_file))[0]
     out_dir = osp.join(destination_dir, case_id)
     if osp.isdir(out_dir):
         shutil.rmtree(out_dir)
-    unzip(source_file, destination_dir)
+    unzip(
+        source_file,
+        destination_dir,
+        (case_id + '/slices/', ) if skip_slices else ())
 
     ann_dir = osp.join(out_dir, 'annotation')
     if osp.isdir(ann_dir):
@@ -91,191 +232,1067 @@ def unzip_case(
     return out_dir
 
 
+def unzip_case_with_size(
+        source_file: str,
+        destination_dir: str,
+        skip_slices: bool = False
+) -> Tuple[str, int]:
+    out_dir = unzip_case(source_file, destination_dir, skip_slices)
+    return out_dir, get_tree_size(out_dir)
+
+
+def open_case(case_dir: str) -> PathLike:
+    if osp.isfile(case_dir) and is_zipfile(case_dir):
+        return open_zip_case(case_dir, annotation_zips)
+    return case_dir
+
+
 def register(
         database: PatientDatabase,
         case_id: str = '',
-        slices_dir: str = '',
+        slices_dir: PathLike = '',
         mvd: str = '',
 ) -> Optional[str]:
     local_id = database.get_local_id(case_id)
     if local_id is None:
         if slices_dir == '':    ###todo:为什么用这个参数判断
             return local_id
-        for root, _, files in os.walk(slices_dir):
-            for file in files:
-                dicom = read_dicom(osp.join(root, file))
-                if dicom is not None:
-                    patient_id = get_patient_id(dicom)
-                    series_id = get_series_instance_uid(dicom)
-                    study_date = get_study_date(dicom)
-                    study_time = get_study_time(dicom)
-                    if None in (
-                            patient_id,
-                            series_id,
-                            study_date,
-                            study_time
-                    ):
-                        continue
+        for dicom_path in dicom_generator(slices_dir):
+            dicom = read_dicom_header(dicom_path)
+            if dicom is not None:
+                patient_id = get_patient_id(dicom)
+                series_id = get_series_instance_uid(dicom)
+                study_date = get_study_date(dicom)
+                study_time = get_study_time(dicom)
+                if None in (
+                        patient_id,
+                        series_id,
+                        study_date,
+                        study_time
+                ):
+                    continue
+
+                study_datetime = study_date + study_time
+                if series_id.startswith('MVD'):
+                    local_id = series_id.split('_')[2]
+                    database.insert_local_id(
+                        patient_id, study_datetime, local_id)   ### todo:再看一下
+                else:
+                    local_id = database.get_local_id_by_meta_info(
+                        patient_id, study_datetime, mvd)    ### todo：在看一下
+                return local_id
+    return local_id
+
+
+def register_case(
+        database: PatientDatabase,
+        case_id: str,
+        case_dir: str,
+        mvd: str
+) -> Optional[str]:
+    local_id = register(database, case_id=case_id)
+    if local_id is None:
+        case = open_case(case_dir)
+        local_id = register(
+            database, slices_dir=join_path(case, 'slices'), mvd=mvd)
+        if isinstance(case, ZipDirectory):
+            case.close()
+        if local_id is not None:
+            database.update_case_progress(case_id, local_id=local_id)
 
-                    study_datetime = study_date + study_time
-                    if series_id.startswith('MVD'):
-                        local_id = series_id.split('_')[2]
-                        database.insert_local_id(
-                            patient_id, study_datetime, local_id)   ### todo:再看一下
-                    else:
-                        local_id = database.get_local_id_by_meta_info(
-                            patient_id, study_datetime, mvd)    ### todo：在看一下
-                    return local_id
     return local_id
 
 
+def get_output_path(
+        output_dir: str,
+        local_id: str,
+        case_id: str,
+        stage: str,
+        volume_format: str = 'npy'
+) -> str:
+    if stage == 'linked':
+        return osp.join(output_dir, local_id, 'slices', case_id)
+    return osp.join(
+        output_dir, local_id, 'segmentation',
+        'slices-' + case_id + '_ori_' + stage +
+        volume_formats[volume_format])
+
+
+def fingerprint_case(source_file: str) -> Dict:
+    '''
+    Fingerprint a case zip and the inputs of each stage from the central
+    directory of the zip (name, size and CRC32 of members), nothing is
+    decompressed
+    :return: {'size', 'mtime', 'hash', 'nested': {nested zip: {'size',
+        'mtime', 'crc'}}, 'stages': {stage: hash of its inputs}}
+    '''
+    case_id = osp.splitext(osp.basename(source_file))[0]
+    slices_prefix = case_id + '/slices/'
+    ann_prefix = case_id + '/annotation/'
+    stat = os.stat(source_file)
+    with ZipFile(source_file) as zf:
+        infos = sorted(zf.infolist(), key=lambda info: info.filename)
+
+    source_hash = hashlib.blake2b(digest_size=16)
+    stage_hashes = {
+        stage: hashlib.blake2b(digest_size=16)
+        for stage in ('linked', ) + preprocess_stages}
+    nested = {}
+    for info in infos:
+        if info.is_dir():
+            continue
+        record = f'{info.filename}\0{info.file_size}\0{info.CRC:08x}\n'
+        record = record.encode()
+        source_hash.update(record)
+        if info.filename.startswith(slices_prefix):
+            stage_hashes['linked'].update(record)
+            stage_hashes['raw'].update(record)
+        elif info.filename.startswith(ann_prefix):
+            file = osp.basename(info.filename)
+            if file in annotation_zips:
+                name = file.split('.')[0]
+                nested[info.filename] = {
+                    'size': info.file_size,
+                    'mtime': '%04d%02d%02d%02d%02d%02d' % info.date_time,
+                    'crc': f'{info.CRC:08x}'}
+            else:
+                name = info.filename[len(ann_prefix):].split('/')[0]
+            for stage, annotations in stage_annotations.items():
+                if name in annotations:
+                    stage_hashes[stage].update(record)
+
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'hash': source_hash.hexdigest(),
+        'nested': nested,
+        'stages': {
+            stage: stage_hash.hexdigest()
+            for stage, stage_hash in stage_hashes.items()}}
+
+
+def get_case_fingerprint(
+        database: PatientDatabase,
+        case_id: str,
+        source_file: str
+) -> Dict:
+    '''
+    :return: fingerprint of a case zip, the one journaled by the former run
+        if the zip has the same size and mtime, see fingerprint_case
+    '''
+    source = database.get_case_manifest(case_id).get('source', None)
+    if source is not None:
+        source = json.loads(source['fingerprint'])
+        stat = os.stat(source_file)
+        if (source['size'], source['mtime']) == \
+                (stat.st_size, stat.st_mtime_ns):
+            return source
+    return fingerprint_case(source_file)
+
+
+def journal_stage(
+        database: PatientDatabase,
+        output_dir: str,
+        case_id: str,
+        local_id: str,
+        stage: str,
+        fingerprint: str,
+        volume_format: str = 'npy'
+):
+    '''
+    record a stage of a case as done, with its output if it has one
+    '''
+    output = get_output_path('', local_id, case_id, stage, volume_format)
+    database.update_case_manifest(
+        case_id,
+        stage,
+        fingerprint,
+        [output] if osp.exists(osp.join(output_dir, output)) else [])
+
+
+def remove_case_dir(path: str):
+    '''
+    rename before removing, so a half removed case is never taken for an
+    unzipped one
+    '''
+    if osp.isdir(path):
+        ### unique, a trash left by a crash may not be empty
+        trash = f'{path}.removing-{uuid.uuid4().hex}'
+        os.replace(path, trash)
+        shutil.rmtree(trash, ignore_errors=True)
+
+
 def preprocess(
         case_id: str,
         case_dir: str,
         local_id: str,
-        output_dir: str
+        output_dir: str,
+        slices_dir: Optional[str] = None,
+        stages: Optional[Iterable[str]] = None,
+        database: Optional[PatientDatabase] = None,
+        fingerprints: Optional[Dict[str, str]] = None,
+        volume_format: str = 'npy',
+        codec: str = 'zlib',
+        slab: int = 1,
+        annotation_format: Optional[str] = None
 ):
-    dicom_list = read_dicom_list(osp.join(case_dir, 'slices'))
-    pixel_array, spacing, case_datetime = parse_dicom_list(
-        dicom_list, ['pixel_array', 'spacing', 'acquisition_datetime'])
+    '''
+    :param stages: outputs to compute among preprocess_stages, by default
+        the raw volume and the annotations not saved yet
+    :param database: journal each stage to, as soon as its output is saved
+    :param fingerprints: stage -> fingerprint of its inputs, to journal
+    :param volume_format: format of the volumes saved, in volume_formats
+    :param codec: compression of .zvol volumes, in zvol_codecs
+    :param slab: number of z-slices in a chunk of .zvol volumes
+    :param annotation_format: format of the annotation volumes, may be
+        'sparse', volume_format by default
+    '''
+    if annotation_format is None:
+        annotation_format = volume_format
+    case_dir = open_case(case_dir)
+    if slices_dir is None:
+        slices_dir = join_path(case_dir, 'slices')
+    with measure(case_id, 'preprocess/headers') as record:
+        series = read_dicom_series(slices_dir)
+        record['slices'] = len(series)
 
     seg_out_dir = osp.join(output_dir, local_id, 'segmentation')
     os.makedirs(seg_out_dir, exist_ok=True)
-    if pixel_array is not None:
-        np.save(
-            osp.join(
-                seg_out_dir,
-                'slices-' + case_id + '_ori_raw.npy'),
-            pixel_array)
-
-    ann_dir = osp.join(case_dir, 'annotation')
-    if osp.isdir(ann_dir):
-        ### save ori organ npy output dir
-        organ_path = osp.join(
-            seg_out_dir, 'slices-' + case_id + '_ori_organ.npy')
-        if not osp.isfile(organ_path):
-            organ = read_organ_annotation(ann_dir)
-            if organ is not None:
-                np.save(organ_path, organ)
-        ### save ori vessel npy output dir
-        vessel_path = osp.join(
-            seg_out_dir, 'slices-' + case_id + '_ori_vessel.npy')
-        if not osp.isfile(vessel_path):
-            vessel = read_vessel_annotation(ann_dir)
-            if vessel is not None:
-                np.save(vessel_path, vessel)
-        ### save ori lesion npy to output dir
-        lesion_path = osp.join(
-            seg_out_dir, 'slices-' + case_id + '_ori_lesion.npy')
-        if not osp.isfile(lesion_path):
-            lesion = read_lesion_annotation(ann_dir)
-            if lesion is not None:
-                np.save(lesion_path, lesion)
+    if series:
+        spacing, case_datetime = parse_header_table(
+            series.table, ['spacing', 'acquisition_datetime'])
+        for problem, indices in check_slice_positions(series.table).items():
+            if len(indices):
+                logger.warning(
+                    f'{case_id}: {len(indices)} slices with {problem} '
+                    f'position.')
+        if stages is None or 'raw' in stages:
+            path = get_output_path(
+                output_dir, local_id, case_id, 'raw', volume_format)
+            with measure(case_id, 'preprocess/raw') as record:
+                volume = open_volume(
+                    path,
+                    get_volume_shape(series),
+                    get_volume_dtype(series),
+                    volume_format)
+                build_volume(series, volume)
+                record['bytes'] = volume.nbytes
+                with measure(case_id, 'preprocess/raw/save'):
+                    close_volume(
+                        volume, path, volume_format, spacing, codec, slab)
+    else:
+        spacing, case_datetime = None, None
+    if database is not None and (stages is None or 'raw' in stages):
+        journal_stage(
+            database, output_dir, case_id, local_id, 'raw',
+            fingerprints['raw'], volume_format)
+
+    ann_dir = join_path(case_dir, 'annotation')
+    annotation_readers = {
+        'organ': read_organ_annotation,
+        'vessel': read_vessel_annotation,
+        'lesion': read_lesion_annotation}
+    for stage, read_annotation in annotation_readers.items():
+        ### save ori organ/vessel/lesion npy to output dir
+        path = get_output_path(
+            output_dir, local_id, case_id, stage, annotation_format)
+        if stages is None:
+            if osp.isfile(path):
+                continue
+        elif stage not in stages:
+            continue
+        elif osp.isfile(path):
+            ### the annotation may have been removed from the case
+            os.remove(path)
+        if is_dir(ann_dir):
+            with measure(case_id, f'preprocess/{stage}') as record:
+                annotation = read_annotation(
+                    ann_dir,
+                    partial(
+                        open_volume, path, volume_format=annotation_format))
+                if annotation is not None:
+                    record['bytes'] = annotation.nbytes
+                    with measure(case_id, f'preprocess/{stage}/save'):
+                        close_volume(
+                            annotation, path, annotation_format, spacing,
+                            codec, slab)
+        if database is not None:
+            journal_stage(
+                database, output_dir, case_id, local_id, stage,
+                fingerprints[stage], annotation_format)
+    if isinstance(case_dir, ZipDirectory):
+        case_dir.close()
 
     logger.info(f'{case_id}: annotation stored.')
     return {'spacing': spacing, 'datetime': case_datetime}
 
 
+def get_save_size(
+        volume_format: str,
+        volume_size: int,
+        slab_size: int,
+        threads: int
+) -> int:
+    '''
+    :return: bytes taken by close_volume on top of the volume, for a copy
+        by SimpleITK, the runs of sparse labels or the slabs being
+        compressed by each thread
+    '''
+    if volume_format == 'niigz':
+        return volume_size
+    if volume_format == 'sparse':
+        return 2 * volume_size
+    if volume_format == 'zvol':
+        return 2 * threads * slab_size
+    return 0
+
+
+def estimate_memory(
+        case_dir: str,
+        slices_dir: Optional[str] = None,
+        stages: Optional[Iterable[str]] = None,
+        threads: int = 1,
+        volume_format: str = 'npy',
+        annotation_format: Optional[str] = None,
+        slab: int = 1
+) -> int:
+    '''
+    Estimate the peak memory of preprocess from the DICOM headers, reading
+    the header of one slice only. Stages run one after the other, the peak
+    is the largest volume written, plus the headers of the series, the
+    slices being decoded by each thread and the memory saving the volume
+    takes in its format, see get_save_size.
+    :params: as preprocess
+    :param threads: threads reading slices in the preprocess worker
+    :return: estimated bytes
+    '''
+    if annotation_format is None:
+        annotation_format = volume_format
+    case_dir = open_case(case_dir)
+    if slices_dir is None:
+        slices_dir = join_path(case_dir, 'slices')
+    if stages is None:
+        stages = preprocess_stages
+
+    slice_count, slice_size, pixel_size = 0, 0, 0
+    for dicom_path in dicom_generator(slices_dir):
+        if slice_size == 0:
+            header = read_dicom_header(dicom_path, volume_tags)
+            if header is not None and 'Rows' in header:
+                pixel_size = header.Rows * header.Columns
+                slice_size = pixel_size * \
+                    getattr(header, 'SamplesPerPixel', 1) * \
+                    (header.BitsAllocated // 8)
+        slice_count += 1
+
+    ### int8 labels, masks are decoded to their dtype, cast and thresholded
+    stage_sizes = [0]
+    if 'raw' in stages:
+        stage_sizes.append(
+            slice_count * slice_size + threads * slice_size +
+            get_save_size(
+                volume_format, slice_count * slice_size, slab * slice_size,
+                threads))
+    ann_dir = join_path(case_dir, 'annotation')
+    if is_dir(ann_dir):
+        layers = set(list_dir(ann_dir))
+        for stage, names in stage_annotations.items():
+            layer_count = len(layers.intersection(names))
+            if stage in stages and layer_count > 0:
+                stage_sizes.append(
+                    slice_count * (pixel_size + layer_count * header_size) +
+                    threads * (slice_size + 2 * pixel_size) +
+                    get_save_size(
+                        annotation_format, slice_count * pixel_size,
+                        slab * pixel_size, threads))
+    if isinstance(case_dir, ZipDirectory):
+        case_dir.close()
+
+    return slice_count * header_size + max(stage_sizes)
+
+
 def save_slices(
         source: str,
-        destination: str
+        destination: str,
+        threads: int = 8
 ):
     os.makedirs(destination, exist_ok=True)
+    copies = []
     for dicom in os.listdir(source):
-        os.link(osp.join(source, dicom), osp.join(destination, dicom))
+        source_path = osp.join(source, dicom)
+        destination_path = osp.join(destination, dicom)
+        if osp.lexists(destination_path):
+            os.remove(destination_path)
+        if not copies:
+            try:
+                os.link(source_path, destination_path)
+                continue
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        copies.append((source_path, destination_path))
 
-    logger.info(f'Create link from {source} to {destination}.')
+    if copies:
+        ### tmp and output are on different file systems
+        with ThreadPoolExecutor(threads) as executor:
+            for _ in executor.map(lambda item: copy_file(*item), copies):
+                pass
+        logger.info(f'Copy slices from {source} to {destination}.')
+    else:
+        logger.info(f'Create link from {source} to {destination}.')
 
 
-if __name__ == '__main__':
-    args = get_parser()
-    logger = get_logger(args)
-    database = PatientDatabase()
-
-    # io_pool = Pool(args.cpus // 3)
-    io_pool = Pool(1)  ###debug test
-    unzipped_cases = []
-    for root, _, files in os.walk(args.data_dir):
-        for file in files:
-            if file.startswith('DI_'):
-                dir = osp.basename(root)
-                if '_' in dir:
-                    _, mvd, category = dir.split('_')
-                else:
-                    break
-                case_id = osp.splitext(file)[0]     # DI_***
-                status = 'not processed' \
-                    if args.overwrite \
-                    else database.get_case_status(case_id)
-                if status == 'unzipped':
-                    case_dir = osp.join(args.tmp_dir, case_id)
-                    if osp.isdir(case_dir):
-                        unzipped_cases.append(
-                            (case_id, mvd, category, case_dir))
-                        logger.info(f'{case_id}: skip unzipping.')
-                        continue
-                    else:
-                        status = 'not processed'
-                        database.update_case_progress(case_id, status=status)
-                unzipped_cases.append(
-                    (case_id,
-                     mvd,
-                     category,
-                     io_pool.apply_async(
-                        unzip_case,
-                        args=(osp.join(root, file), args.tmp_dir))))
-
-    # preprocess_pool = Pool(args.cpus - args.cpus // 3)
-    preprocess_pool = Pool(1)      ###debug test
-    processed_cases = []
-    saved_cases = []
-    for case_id, mvd, category, case_dir in unzipped_cases:
-        if not isinstance(case_dir, str):
-            case_dir = case_dir.get()
-            database.update_case_progress(case_id, status='unzipped')
-
-        local_id = register(database, case_id=case_id)
-        slices_dir = osp.join(case_dir, 'slices')
-        if local_id is None:
-            local_id = register(database, slices_dir=slices_dir, mvd=mvd)
-            if local_id is None:
-                logger.error(
-                    f'Failed to register {case_id}({category}) in {mvd}.')
+def extract_slices(
+        source_file: str,
+        destination: str
+):
+    case_id = osp.splitext(osp.basename(source_file))[0]
+    slices_prefix = case_id + '/slices/'
+    os.makedirs(destination, exist_ok=True)
+    with ZipFile(source_file) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not info.filename.startswith(slices_prefix):
                 continue
-            database.update_case_progress(case_id, local_id=local_id)
+            path = osp.join(destination, info.filename[len(slices_prefix):])
+            os.makedirs(osp.dirname(path), exist_ok=True)
+            with zf.open(info) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+    logger.info(f'Extract slices from {source_file} to {destination}.')
+
+
+class Case:
+    '''
+    State of a case going through the pipeline
+    :param order: key ordering the cases in the outputs, the same whatever
+        the order they are found or done in
+    '''
+    def __init__(
+            self,
+            order: Tuple[str, str],
+            case_id: str,
+            mvd: str,
+            category: str,
+            source_file: str
+    ):
+        self.order = order
+        self.case_id = case_id
+        self.mvd = mvd
+        self.category = category
+        self.source_file = source_file
+        self.case_dir = None
+        self.local_id = None
+        self.pending = set()
+        self.tmp_size = 0
+        self.mem_size = 0
+        self.overtaken = 0
+        self.fingerprint = None
+        self.stages = set(('linked', ) + preprocess_stages)
+        ### a stage failed, the case is not recorded as done
+        self.failed = False
+        self.finished = False
+
+
+class Pipeline:
+    '''
+    fingerprint -> unzip -> register -> (save slices, preprocess) of every
+    case, each stage starts as soon as the stage before is done for that
+    case. Stages whose inputs are unchanged since the last run are skipped
+    '''
+    ### times a case waiting for memory may be overtaken by smaller ones
+    max_overtaken = 4
+
+    def __init__(
+            self,
+            args: argparse.Namespace,
+            database: PatientDatabase,
+            scheduler: Scheduler
+    ):
+        self.args = args
+        self.database = database
+        self.scheduler = scheduler
+        self.case_infos = []
+        self.tmp_usage = 0
+        self.waiting = deque()
+        self.mem_usage = 0
+        self.mem_waiting = []
+
+    def submit(
+            self,
+            executor: str,
+            callback: Callable[[Future], None],
+            case: Case,
+            stage: str,
+            func: Callable,
+            *args
+    ):
+        ### measured in the worker, see utils.metrics
+        self.scheduler.submit(
+            executor, partial(self.call_back, case, stage, callback),
+            call_measured, case.case_id, stage, func, *args)
+
+    def call_back(
+            self,
+            case: Case,
+            stage: str,
+            callback: Callable[[Future], None],
+            future: Future
+    ):
+        ### a callback raising must not keep the case in flight for ever
+        try:
+            callback(future)
+        except Exception:
+            logger.exception(f'{case.case_id}: callback of {stage} failed.')
+            ### preprocess is pending while its memory is estimated
+            self.fail(case, 'preprocess' if stage == 'estimate' else stage)
+
+    def get_stale_stages(self, case: Case) -> set:
+        manifest = self.database.get_case_manifest(case.case_id)
+        if self.args.overwrite:
+            return set(case.stages)
+
+        stale = set()
+        for stage in case.stages:
+            record = manifest.get(stage, None)
+            if record is None or \
+                    record['fingerprint'] != \
+                    self.get_stage_fingerprint(case, stage) or \
+                    not all(
+                        osp.exists(osp.join(self.args.output_dir, output))
+                        for output in record['outputs']):
+                stale.add(stage)
+        return stale
+
+    def get_stage_fingerprint(self, case: Case, stage: str) -> str:
+        ### volumes are saved again once their format changes
+        fingerprint = case.fingerprint['stages'][stage]
+        volume_format = self.get_volume_format(stage)
+        if volume_format in (None, 'npy'):
+            return fingerprint
+        if volume_format == 'zvol':
+            return f'{fingerprint}:zvol:{self.args.codec}:{self.args.slab}'
+        return f'{fingerprint}:{volume_format}'
+
+    def get_volume_format(self, stage: str) -> Optional[str]:
+        if stage not in preprocess_stages:
+            return None
+        if stage != 'raw' and self.args.sparse_annotations:
+            return 'sparse'
+        return self.args.output_format
+
+    def start(self, case: Case):
+        ### the zip is read in an io task, not to hold up the scheduler
+        self.submit(
+            'io',
+            partial(self.on_fingerprinted, case),
+            case, 'fingerprint',
+            get_case_fingerprint,
+            self.database, case.case_id, case.source_file)
+
+    def on_fingerprinted(self, case: Case, future: Future):
+        if not self.check(case, future, 'fingerprint'):
+            return
+        case.fingerprint = future.result()
+        ### a broken or vanished zip fails its case, not the run
+        try:
+            self.start_case(case)
+        except Exception:
+            logger.exception(f'{case.case_id}: failed to start.')
+            ### not unzipped, its size is not counted in tmp_usage
+            if case in self.waiting:
+                self.waiting.remove(case)
+                case.tmp_size = 0
+            self.fail(case, 'start')
+
+    def start_case(self, case: Case):
+        case.stages = self.get_stale_stages(case)
+        if not case.stages and \
+                self.database.get_case_status(case.case_id) == 'done':
+            logger.info(f'{case.case_id}: up to date.')
+            self.scheduler.release()
+            return
+
+        if self.args.read_zip:
+            case.case_dir = case.source_file
+            self.register(case)
+            return
+
+        ### only the slices to extract, nothing to unzip
+        if not case.stages.intersection(preprocess_stages) and (
+                'linked' not in case.stages or self.args.direct_slices):
+            case.case_dir = case.source_file
+            self.register(case)
+            return
+
+        ### reuse a case unzipped by a former run, from the same source
+        unzipped = self.database.get_case_manifest(case.case_id).get(
+            'unzipped', None)
+        case_dir = osp.join(self.args.tmp_dir, case.case_id)
+        if not self.args.overwrite and unzipped is not None and \
+                unzipped['fingerprint'] == self.get_unzip_fingerprint(case) \
+                and osp.isdir(case_dir):
+            case.case_dir = case_dir
+            case.tmp_size = get_tree_size(case_dir)
+            self.tmp_usage += case.tmp_size
+            logger.info(f'{case.case_id}: skip unzipping.')
+            self.register(case)
+            return
+        case.tmp_size = get_zip_size(
+            case.source_file,
+            (case.case_id + '/slices/', ) if self.args.direct_slices else ())
+        self.waiting.append(case)
+        self.unzip_waiting()
+
+    def unzip_waiting(self):
+        ### backpressure: one case is always allowed, not to stall on a case
+        ### larger than the budget
+        while self.waiting and (
+                self.args.tmp_budget <= 0 or
+                self.tmp_usage == 0 or
+                self.tmp_usage + self.waiting[0].tmp_size <=
+                self.args.tmp_budget):
+            case = self.waiting.popleft()
+            self.tmp_usage += case.tmp_size
+            self.submit(
+                'io',
+                partial(self.on_unzipped, case),
+                case, 'unzip',
+                unzip_case_with_size,
+                case.source_file, self.args.tmp_dir, self.args.direct_slices)
+
+    def on_unzipped(self, case: Case, future: Future):
+        if not self.check(case, future, 'unzip'):
+            return
+        case.case_dir, tmp_size = future.result()
+        self.tmp_usage += tmp_size - case.tmp_size
+        case.tmp_size = tmp_size
+        self.database.update_case_manifest(
+            case.case_id, 'unzipped', self.get_unzip_fingerprint(case))
+        self.database.update_case_progress(case.case_id, status='unzipped')
+        self.register(case)
+
+    def get_unzip_fingerprint(self, case: Case) -> str:
+        ### slices are not unzipped with --direct-slices
+        return f'{case.fingerprint["hash"]}:{int(self.args.direct_slices)}'
+
+    def register(self, case: Case):
+        ### slices are not unzipped with --direct-slices, read from the zip
+        self.submit(
+            'io',
+            partial(self.on_registered, case),
+            case, 'register',
+            register_case,
+            self.database,
+            case.case_id,
+            case.source_file if self.args.direct_slices else case.case_dir,
+            case.mvd)
+
+    def on_registered(self, case: Case, future: Future):
+        if not self.check(case, future, 'register'):
+            return
+        case.local_id = future.result()
+        if case.local_id is None:
+            logger.error(
+                f'Failed to register {case.case_id}({case.category}) '
+                f'in {case.mvd}.')
+            self.fail(case, 'register')
+            return
+        self.database.update_case_manifest(
+            case.case_id, 'registered', case.fingerprint['stages']['linked'])
+
         ### save file to output dir
-        saved_cases.append((
-            case_id,
-            io_pool.apply_async(
-                save_slices,
-                args=(
-                    slices_dir,
-                    osp.join(
-                        args.output_dir, local_id, 'slices', case_id)))))
+        slices_dir = osp.join(case.case_dir, 'slices')
+        output_slices_dir = get_output_path(
+            self.args.output_dir, case.local_id, case.case_id, 'linked')
+        if 'linked' in case.stages:
+            case.pending.add('save')
+            if self.args.read_zip or self.args.direct_slices:
+                self.submit(
+                    'io',
+                    partial(self.on_done, case, 'save'),
+                    case, 'save',
+                    extract_slices, case.source_file, output_slices_dir)
+            else:
+                self.submit(
+                    'io',
+                    partial(self.on_done, case, 'save'),
+                    case, 'save',
+                    save_slices, slices_dir, output_slices_dir)
 
         ### preprocess
-        if osp.isdir(case_dir):
-            processed_cases.append((
-                local_id,
-                case_id,
-                category,
-                preprocess_pool.apply_async(
-                    preprocess,
-                    args=(
-                        case_id,
-                        case_dir,
-                        local_id,
-                        args.output_dir))))
+        if not case.stages.intersection(preprocess_stages):
+            pass
+        elif self.args.direct_slices:
+            ### reads the extracted slices, once they are saved
+            case.pending.add('preprocess')
+            if 'save' not in case.pending:
+                self.preprocess(case, output_slices_dir)
+        elif osp.isdir(case.case_dir) or self.args.read_zip:
+            case.pending.add('preprocess')
+            self.preprocess(case)
         else:
             logger.error(f'{slices_dir} is not a directory.')
-    ### update case progress
+            ### preprocess never runs, the case is not done
+            case.failed = True
+        if not case.pending:
+            self.on_finished(case)
+
+    def preprocess(self, case: Case, slices_dir: Optional[str] = None):
+        if self.args.mem_budget <= 0:
+            self.submit_preprocess(case, slices_dir)
+            return
+        self.submit(
+            'io',
+            partial(self.on_estimated, case, slices_dir),
+            case, 'estimate',
+            estimate_memory,
+            case.case_dir, slices_dir,
+            case.stages.intersection(preprocess_stages),
+            self.args.slice_threads, self.args.output_format,
+            self.get_volume_format('organ'), self.args.slab)
+
+    def on_estimated(
+            self,
+            case: Case,
+            slices_dir: Optional[str],
+            future: Future
+    ):
+        if future.exception() is None:
+            case.mem_size = future.result()
+        else:
+            ### preprocess on its own, it will fail the same way
+            logger.error(
+                f'{case.case_id}: failed to estimate memory.',
+                exc_info=future.exception())
+            case.mem_size = self.args.mem_budget
+        if case.mem_size > self.args.mem_budget:
+            logger.warning(
+                f'{case.case_id}: needs about {case.mem_size >> 20}M, '
+                f'more than --mem-budget, preprocessed alone.')
+        self.mem_waiting.append((case, slices_dir))
+        self.admit_preprocess()
+
+    def admit_preprocess(self):
+        ### first come first served, but cases that fit may overtake one that
+        ### does not, until it has been overtaken max_overtaken times. One
+        ### case is always allowed, not to stall on a case larger than the
+        ### budget
+        i = 0
+        while i < len(self.mem_waiting):
+            case, slices_dir = self.mem_waiting[i]
+            if self.mem_usage == 0 or \
+                    self.mem_usage + case.mem_size <= self.args.mem_budget:
+                del self.mem_waiting[i]
+                for former, _ in self.mem_waiting[:i]:
+                    former.overtaken += 1
+                self.mem_usage += case.mem_size
+                self.submit_preprocess(case, slices_dir)
+            elif case.overtaken >= self.max_overtaken:
+                break
+            else:
+                i += 1
+
+    def on_preprocessed(self, case: Case, future: Future):
+        self.mem_usage -= case.mem_size
+        case.mem_size = 0
+        self.admit_preprocess()
+        self.on_done(case, 'preprocess', future)
+
+    def submit_preprocess(
+            self,
+            case: Case,
+            slices_dir: Optional[str] = None
+    ):
+        self.submit(
+            'preprocess',
+            partial(self.on_preprocessed, case),
+            case, 'preprocess',
+            preprocess,
+            case.case_id, case.case_dir, case.local_id,
+            self.args.output_dir, slices_dir,
+            case.stages.intersection(preprocess_stages),
+            self.database,
+            {
+                stage: self.get_stage_fingerprint(case, stage)
+                for stage in preprocess_stages},
+            self.args.output_format, self.args.codec, self.args.slab,
+            self.get_volume_format('organ'))
+
+    def on_done(self, case: Case, stage: str, future: Future):
+        if not self.check(case, future, stage):
+            return
+        case.pending.discard(stage)
+        if stage == 'save':
+            self.update_manifest(case, ['linked'])
+            if self.args.direct_slices and 'preprocess' in case.pending:
+                self.preprocess(
+                    case,
+                    get_output_path(
+                        self.args.output_dir, case.local_id, case.case_id,
+                        'linked'))
+        ### update case progress
+        if stage == 'preprocess':
+            ### stages are journaled by the worker, one by one
+            case_info = future.result()
+            case_info['category'] = case.category
+            self.case_infos.append((case.order, case, case_info))
+            if case.pending:
+                self.database.update_case_progress(
+                    case.case_id, status='processed')
+        if not case.pending:
+            self.on_finished(case)
+
+    def on_finished(self, case: Case):
+        if case.failed:
+            ### done again by the next run, from the stages journaled
+            self.database.update_case_progress(case.case_id, status='failed')
+        else:
+            self.database.update_case_manifest(
+                case.case_id, 'source', json.dumps(case.fingerprint))
+            self.database.update_case_progress(case.case_id, status='done')
+        self.finish(case)
+
+    def update_manifest(self, case: Case, stages: Iterable[str]):
+        for stage in stages:
+            journal_stage(
+                self.database, self.args.output_dir, case.case_id,
+                case.local_id, stage, self.get_stage_fingerprint(case, stage))
+
+    def check(self, case: Case, future: Future, stage: str) -> bool:
+        if future.exception() is None:
+            return True
+        logger.error(
+            f'{case.case_id}: {stage} failed.', exc_info=future.exception())
+        self.fail(case, stage)
+        return False
+
+    def fail(self, case: Case, stage: str):
+        case.failed = True
+        if stage == 'save' and self.args.direct_slices:
+            ### preprocess waits for the slices, it will never be submitted
+            case.pending.discard('preprocess')
+        case.pending.discard(stage)
+        if not case.pending and not case.finished:
+            self.on_finished(case)
+
+    def finish(self, case: Case):
+        if case.finished:
+            return
+        case.finished = True
+        ### remove the unzipped case as soon as it is not used any more
+        if not self.args.read_zip:
+            self.submit(
+                'io',
+                partial(self.on_cleaned, case),
+                case, 'clean',
+                remove_case_dir,
+                osp.join(self.args.tmp_dir, case.case_id))
+        self.scheduler.release()
+
+    def on_cleaned(self, case: Case, future: Future):
+        if future.exception() is not None:
+            logger.error(
+                f'{case.case_id}: failed to remove unzipped files.',
+                exc_info=future.exception())
+        self.tmp_usage -= case.tmp_size
+        case.tmp_size = 0
+        self.unzip_waiting()
+
+
+def init_worker(
+        slice_threads: int,
+        metrics_path: str,
+        run_id: str,
+        profile_dir: Optional[str],
+        log_queue: multiprocessing.Queue,
+        log_levels: Dict[str, str]
+):
+    set_io_threads(slice_threads)
+    init_metrics(metrics_path, run_id, profile_dir)
+    init_logging(log_queue, log_levels)
+
+
+def scan_dir(path: str, cached: Optional[Dict]) -> Dict:
+    '''
+    :param cached: former scan of path, reused if path is not modified since
+    :return: {'mtime', 'files': names of DI_* files, 'dirs': names of
+        sub-directories to walk}, symlinks to directories are not walked
+        like os.walk
+    '''
+    mtime = os.stat(path).st_mtime_ns
+    if cached is not None and cached['mtime'] == mtime:
+        return cached
+    files, dirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    dirs.append(entry.name)
+            elif entry.name.startswith('DI_'):
+                files.append(entry.name)
+    return {'mtime': mtime, 'files': sorted(files), 'dirs': sorted(dirs)}
+
+
+def scan_data_dir(
+        data_dir: str,
+        cases: 'queue.Queue',
+        threads: int = 8,
+        cache_path: Optional[str] = None
+):
+    '''
+    Walk data_dir with threads, putting (dir, DI_* file) into cases as soon
+    as they are found then None. Listings of directories whose mtime is
+    unchanged are taken from the cache of the former scan.
+    :param cache_path: json of the directories scanned, None not to cache
+    '''
+    cache = {}
+    if cache_path is not None and osp.isfile(cache_path):
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except ValueError:
+            logger.warning(f'Ignore broken scan cache {cache_path}.')
+    scanned = {}
+    try:
+        with ThreadPoolExecutor(max(1, threads)) as executor:
+            ### cached by absolute path, the same from any working directory
+            running = {
+                executor.submit(
+                    scan_dir, data_dir, cache.get(osp.abspath(data_dir))):
+                    data_dir}
+            while running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = running.pop(future)
+                    if future.exception() is not None:
+                        logger.error(
+                            f'Failed to scan {path}.',
+                            exc_info=future.exception())
+                        continue
+                    listing = future.result()
+                    scanned[osp.abspath(path)] = listing
+                    for file in listing['files']:
+                        cases.put((path, file))
+                    for name in listing['dirs']:
+                        sub_dir = osp.join(path, name)
+                        running[executor.submit(
+                            scan_dir, sub_dir,
+                            cache.get(osp.abspath(sub_dir)))] = sub_dir
+        if cache_path is not None:
+            tmp_path = get_tmp_path(cache_path)
+            with open(tmp_path, 'w') as f:
+                json.dump(scanned, f)
+            replace_file(tmp_path, cache_path)
+    finally:
+        cases.put(None)
+
+
+def discover_cases(
+        data_dir: str,
+        threads: int = 8,
+        cache_path: Optional[str] = None,
+        poll_interval: float = 0.1
+) -> Generator[Case, None, None]:
+    '''
+    Cases of data_dir/**/<any>_<mvd>_<category>/DI_*, streamed while
+    data_dir is walked in the background, see scan_data_dir. Yields
+    not_ready when the next case is not found within poll_interval. Cases
+    come in the order they are found, they are ordered by (category, path
+    relative to data_dir).
+    '''
+    cases = queue.Queue()
+    scanner = threading.Thread(
+        target=scan_data_dir,
+        args=(data_dir, cases, threads, cache_path),
+        daemon=True)
+    scanner.start()
+    while True:
+        try:
+            item = cases.get(timeout=poll_interval)
+        except queue.Empty:
+            yield not_ready
+            continue
+        if item is None:
+            break
+        root, file = item
+        dir = osp.basename(root)
+        if '_' not in dir:
+            continue
+        parts = dir.split('_')
+        if len(parts) != 3:
+            logger.warning(f'Skip {root}, not named <any>_<mvd>_<category>.')
+            continue
+        _, mvd, category = parts
+        case_id = osp.splitext(file)[0]     # DI_***
+        source_file = osp.join(root, file)
+        yield Case(
+            (category, osp.relpath(source_file, data_dir)),
+            case_id, mvd, category, source_file)
+    scanner.join()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    log_queue = multiprocessing.Queue()
+    log_listener = get_logger(args, log_queue)
+    ### database is served by a manager process, shared by pool workers
+    database_manager = DatabaseManager()
+    database_manager.start()
+    database = database_manager.PatientDatabase()
+
+    io_workers = max(1, args.cpus // 3)
+    preprocess_workers = max(
+        1, (args.cpus - io_workers) // args.slice_threads)
+    ### every stage of every case is recorded in metrics.jsonl
+    ### unique even for runs started in the same second
+    run_id = datetime.datetime.now().strftime('%Y%m%d%H%M%S') + \
+        f'-{os.getpid()}'
+    metrics_path = osp.join(args.output_dir, 'metrics.jsonl')
+    profile_dir = osp.join(args.output_dir, 'profile', run_id) \
+        if args.profile else None
+    init_metrics(metrics_path, run_id, profile_dir)
+    io_executor = ProcessPoolExecutor(
+        io_workers,
+        initializer=init_worker,
+        initargs=(
+            1, metrics_path, run_id, profile_dir, log_queue,
+            get_log_levels(args)))
+    preprocess_executor = ProcessPoolExecutor(
+        preprocess_workers,
+        initializer=init_worker,
+        initargs=(
+            args.slice_threads, metrics_path, run_id, profile_dir, log_queue,
+            get_log_levels(args)))
+    scheduler = Scheduler(
+        {'io': io_executor, 'preprocess': preprocess_executor},
+        {'io': 2 * io_workers, 'preprocess': 2 * preprocess_workers})
+    pipeline = Pipeline(args, database, scheduler)
+    scheduler.run(
+        discover_cases(
+            args.data_dir,
+            args.scan_threads,
+            None if args.overwrite else osp.join(
+                osp.dirname(osp.abspath(__file__)), 'databases',
+                'scan_cache.json')),
+        pipeline.start,
+        args.max_in_flight or 2 * (io_workers + preprocess_workers))
+
     patient_infos = {}
-    for local_id, case_id, category, case_info in processed_cases:
-        case_info = case_info.get()
-        database.update_case_progress(case_id, status='processed')
-        case_info['category'] = category
-        seq_properties = patient_infos.setdefault(local_id, {})
-        seq_properties['slices/' + case_id] = case_info
+    for _, case, case_info in sorted(
+            pipeline.case_infos, key=lambda item: item[0]):
+        seq_properties = patient_infos.get(case.local_id, None)
+        if seq_properties is None:
+            ### keep cases of former runs, skipped in this run
+            seq_properties_path = osp.join(
+                args.output_dir, case.local_id, 'seq_properties.json')
+            if osp.isfile(seq_properties_path):
+                seq_properties = json.load(open(seq_properties_path))
+            else:
+                seq_properties = {}
+            for former_case_info in seq_properties.values():
+                former_case_info.pop('group', None)
+            patient_infos[case.local_id] = seq_properties
+        seq_properties['slices/' + case.case_id] = case_info
     ### write info to seq_properties.json
     for local_id, patient_info in patient_infos.items():
         time2rpath_list = {}
@@ -290,30 +1307,48 @@ if __name__ == '__main__':
                 for rpath in rpath_list:
                     patient_info[rpath]['group'] = i
 
-        json.dump(
-            patient_info,
-            open(
-                osp.join(args.output_dir, local_id, 'seq_properties.json'),
-                'w'),
-            indent=2)
+        seq_properties_path = osp.join(
+            args.output_dir, local_id, 'seq_properties.json')
+        tmp_path = get_tmp_path(seq_properties_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(patient_info, f, indent=2, allow_nan=False)
+        replace_file(tmp_path, seq_properties_path)
 
-    preprocess_pool.close()
-    preprocess_pool.join()
+    preprocess_executor.shutdown()
 
-    ### update case progress
-    for case_id, save_task in saved_cases:
-        save_task.get()
-        database.update_case_progress(case_id, status='done')
+    if args.index_headers:
+        with HeaderIndex() as header_index:
+            for entry in os.scandir(args.output_dir):
+                slices_dir = osp.join(entry.path, 'slices')
+                if entry.is_dir() and osp.isdir(slices_dir):
+                    parsed, removed = header_index.update(
+                        slices_dir, args.cpus)
+                    if parsed or removed:
+                        logger.info(
+                            f'{entry.name}: {parsed} slices indexed, '
+                            f'{removed} removed.')
 
     ####remove tmp file
     logger.info(
         f'Finish rearanging data from middle platform. '
         f'Removing cache in {args.tmp_dir}')
-    for root, dirs, files in os.walk(args.tmp_dir):
-        for dir in dirs:
-            io_pool.apply_async(shutil.rmtree, args=(osp.join(root, dir), ))
-        for file in files:
-            io_pool.apply_async(shutil.rmtree, args=(osp.join(root, file), ))
-
-    io_pool.close()
-    io_pool.join()
+    for entry in os.scandir(args.tmp_dir):
+        if entry.is_dir(follow_symlinks=False):
+            io_executor.submit(shutil.rmtree, entry.path)
+        else:
+            io_executor.submit(os.remove, entry.path)
+
+    io_executor.shutdown()
+
+    database.export_json()
+    database.close()
+    database_manager.shutdown()
+
+    summary = summarize_metrics(read_metrics(metrics_path, run_id))
+    log_summary(summary, logger)
+    summary_path = osp.join(args.output_dir, 'metrics_summary.json')
+    tmp_path = get_tmp_path(summary_path)
+    with open(tmp_path, 'w') as f:
+        json.dump({'run': run_id, 'stages': summary}, f, indent=2)
+    replace_file(tmp_path, summary_path)
+    log_listener.stop()
@@ -0,0 +1,5 @@
+import os.path as osp
+import sys
+
+### modules are imported from the root of the repo, as run.py does
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
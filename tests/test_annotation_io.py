@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from utils.annotation_io import encode_sparse_labels, decode_sparse_labels, \
+    save_sparse_labels, load_sparse_labels
+
+
+def make_labels(seed: int, shape=(9, 12, 10)) -> np.ndarray:
+    rng = np.random.RandomState(seed)
+    labels = np.zeros(shape, np.int8)
+    for label in range(1, 4):
+        z, y, x = (rng.randint(0, size) for size in shape)
+        labels[z:z + 4, y:y + 5, x:x + 3] = label
+    return labels
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sparse_round_trip(seed):
+    labels = make_labels(seed)
+    sparse = encode_sparse_labels(labels)
+    decoded = decode_sparse_labels(sparse)
+    assert decoded.dtype == labels.dtype
+    assert np.array_equal(decoded, labels)
+    ### runs cover the bounding box, which holds every label
+    bbox = sparse['bbox']
+    assert sparse['lengths'].sum() == np.prod(bbox[:, 1] - bbox[:, 0])
+    assert np.count_nonzero(labels) == np.count_nonzero(
+        labels[tuple(slice(*extent) for extent in bbox)])
+
+
+def test_sparse_empty_and_full():
+    for labels in (np.zeros((3, 4, 5), np.int8), np.ones((3, 4, 5), np.int8)):
+        assert np.array_equal(
+            decode_sparse_labels(encode_sparse_labels(labels)), labels)
+
+
+def test_sparse_save_load(tmp_path):
+    labels = make_labels(0)
+    path = str(tmp_path / 'labels.sparse.npz')
+    save_sparse_labels(labels, path)
+    assert np.array_equal(load_sparse_labels(path), labels)
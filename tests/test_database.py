@@ -0,0 +1,74 @@
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.database import LocalIdAllocator, PatientDatabase, \
+    DatabaseManager
+
+
+def probe_local_id(mvd: str, local_id_set: set) -> str:
+    ### lowest free local id, as allocated before LocalIdAllocator
+    prefix = f'PA-{int(mvd[3:]):0>2}-'
+    i = 0
+    while prefix + f'{i:0>4}' in local_id_set:
+        i += 1
+    return prefix + f'{i:0>4}'
+
+
+def test_allocator_matches_probe():
+    rng = random.Random(0)
+    for _ in range(50):
+        mvd = f'MVD{rng.choice((1, 16, 123))}'
+        prefix = f'PA-{int(mvd[3:]):0>2}-'
+        local_id_set = {
+            prefix + f'{rng.randrange(300):0>4}'
+            for _ in range(rng.randrange(200))}
+        ### ids of other forms are never allocated, nor taken
+        local_id_set.update({prefix + '12', prefix + '00012', 'PA-99-0000'})
+        allocator = LocalIdAllocator(mvd, local_id_set)
+        for _ in range(300):
+            if rng.random() < 0.2:
+                local_id = prefix + f'{rng.randrange(600):0>4}'
+                allocator.add(local_id)
+            else:
+                local_id = allocator.allocate()
+                assert local_id == probe_local_id(mvd, local_id_set)
+            local_id_set.add(local_id)
+
+
+def test_allocator_unique():
+    allocator = LocalIdAllocator('MVD16', ['PA-16-0000', 'PA-16-0005'])
+    local_ids = [allocator.allocate() for _ in range(1000)]
+    assert len(set(local_ids)) == len(local_ids)
+    assert not {'PA-16-0000', 'PA-16-0005'}.intersection(local_ids)
+    assert local_ids[:5] == [
+        'PA-16-0001', 'PA-16-0002', 'PA-16-0003', 'PA-16-0004', 'PA-16-0006']
+
+
+def register_patients(database, patient_ids, mvd: str = 'MVD16'):
+    return [
+        database.get_local_id_by_meta_info(
+            patient_id, '20210422130746', mvd)
+        for patient_id in patient_ids]
+
+
+def test_manager_concurrent_allocation(tmp_path):
+    manager = DatabaseManager()
+    manager.start()
+    try:
+        database = manager.PatientDatabase(str(tmp_path))
+        ### every patient is registered by 4 workers at once
+        patient_ids = [f'P{i:04d}' for i in range(200)]
+        with ProcessPoolExecutor(4) as executor:
+            futures = [
+                executor.submit(register_patients, database, patient_ids)
+                for _ in range(4)]
+            results = [future.result() for future in futures]
+        assert all(result == results[0] for result in results)
+        assert len(set(results[0])) == len(patient_ids)
+        database.close()
+    finally:
+        manager.shutdown()
+
+    database = PatientDatabase(str(tmp_path))
+    assert register_patients(database, patient_ids) == results[0]
+    database.close()
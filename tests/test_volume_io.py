@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from utils.volume_io import ChunkedVolume, save_chunked_volume, \
+    open_volume, close_volume, load_volume
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+@pytest.mark.parametrize('slab', [1, 3, 7, 20])
+def test_zvol_round_trip(tmp_path, codec, slab):
+    rng = np.random.RandomState(slab)
+    volume = rng.randint(-1024, 2048, (7, 5, 6)).astype(np.int16)
+    path = str(tmp_path / 'volume.zvol')
+    save_chunked_volume(volume, path, codec, slab)
+
+    cache = {}
+    with ChunkedVolume(path, cache) as chunked:
+        assert chunked.shape == volume.shape
+        assert chunked.dtype == volume.dtype
+        assert np.array_equal(chunked.read(), volume)
+        for start, stop in [(0, 1), (2, 5), (5, 7), (6, 100), (4, 4)]:
+            assert np.array_equal(
+                chunked[start:stop], volume[start:stop])
+        assert np.array_equal(chunked[-1], volume[-1])
+        assert np.array_equal(chunked[3, 1:4, ::2], volume[3, 1:4, ::2])
+        assert np.array_equal(chunked[::2], volume[::2])
+        with pytest.raises(IndexError):
+            chunked[7]
+    ### chunks are read from the cache once the file is closed
+    with ChunkedVolume(path, cache) as chunked:
+        chunked.file.close()
+        assert np.array_equal(chunked.read(), volume)
+
+
+def test_zvol_open_close(tmp_path):
+    volume = np.arange(4 * 3 * 2, dtype=np.int8).reshape(4, 3, 2)
+    path = str(tmp_path / 'labels.zvol')
+    out = open_volume(path, volume.shape, volume.dtype, 'zvol')
+    out[:] = volume
+    close_volume(out, path, 'zvol', slab=3)
+    ### the scratch volume is removed
+    assert os.listdir(tmp_path) == ['labels.zvol']
+    assert np.array_equal(load_volume(path)[:], volume)
+
+
+@pytest.mark.parametrize('spacing', [
+    [0., 0.7, 0.8], [np.nan, 0.7, 0.8], [None, 0.7, 0.8]])
+def test_niigz_single_slice(tmp_path, spacing):
+    ### the thickness of a series of one slice is 0
+    volume = np.arange(12, dtype=np.int8).reshape(1, 3, 4)
+    path = str(tmp_path / 'volume.nii.gz')
+    close_volume(volume.copy(), path, 'niigz', spacing)
+    assert np.array_equal(load_volume(path), volume)
+    image = sitk.ReadImage(path)
+    assert np.allclose(image.GetSpacing(), [0.8, 0.7, 1.])
@@ -1,169 +1,307 @@
+import errno
+import io
 import os
 import os.path as osp
+import shutil
 from zipfile import is_zipfile, ZipFile
 import logging
-from typing import Optional
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, \
+    Tuple
 
 import SimpleITK as sitk
 import numpy as np
 
-from utils.dicom_io import read_dicom_list, parse_dicom_list
+from utils.dicom_io import read_dicom, read_dicom_series, \
+    read_dicom_volume, get_volume_shape, get_pixel_array, map_slices, \
+    ZipDirectory, PathLike, join_path, list_dir, get_tmp_path, replace_file
 
 
-def unzip(source: str, destination: str):
+def unzip(source: str, destination: str, exclude: Iterable[str] = ()):
+    '''
+    :param exclude: prefixes of members not to extract
+    '''
     if is_zipfile(source):
         zf = ZipFile(source)
-        zf.extractall(destination)
+        exclude = tuple(exclude)
+        if exclude:
+            zf.extractall(
+                destination,
+                [name for name in zf.namelist()
+                 if not name.startswith(exclude)])
+        else:
+            zf.extractall(destination)
         zf.close()
 
 
-def save_numpy_as_niigz(arr: np.ndarray, destination: str):
+def get_zip_size(source: str, exclude: Iterable[str] = ()) -> int:
+    '''
+    uncompressed size of a zip, from its central directory
+    '''
+    exclude = tuple(exclude)
+    with ZipFile(source) as zf:
+        return sum(
+            info.file_size for info in zf.infolist()
+            if not exclude or not info.filename.startswith(exclude))
+
+
+def copy_file(source: str, destination: str):
+    '''
+    Copy a file in the kernel with copy_file_range or sendfile, falls back
+    to a user space copy where neither is supported
+    '''
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        for copy in (
+                getattr(os, 'copy_file_range', None),
+                lambda fd_in, fd_out, count: os.sendfile(
+                    fd_out, fd_in, None, count)):
+            if copy is None:
+                continue
+            try:
+                while offset < size:
+                    copied = copy(src.fileno(), dst.fileno(), size - offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+                return
+            except OSError as e:
+                # not supported between these file systems, try the next
+                if offset > 0 or e.errno not in (
+                        errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.ENOTSUP):
+                    raise
+        shutil.copyfileobj(src, dst)
+
+
+def get_tree_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            size += os.lstat(osp.join(root, file)).st_size
+    return size
+
+
+def open_zip_case(
+        source: str,
+        nested_zips: Iterable[str]
+) -> ZipDirectory:
+    '''
+    Mount a case zip the way it would be laid out by unzipping it, nested
+    annotation zips are mounted as annotation/<name> in memory
+    :param source: path of DI_*.zip
+    :param nested_zips: file names of nested zips to mount
+    :return: directory view of the case
+    '''
+    case_id = osp.splitext(osp.basename(source))[0]
+    nested_zips = set(nested_zips)
+    ann_prefix = case_id + '/annotation/'
+
+    case_zip = ZipFile(source)
+    root = ZipDirectory()
+    for info in case_zip.infolist():
+        if info.is_dir():
+            continue
+        name = info.filename
+        file = osp.basename(name)
+        if name.startswith(ann_prefix) and file in nested_zips:
+            nested = ZipFile(io.BytesIO(case_zip.read(name)))
+            root.add_zip(nested, ann_prefix + file.split('.')[0])
+        else:
+            root.add_member(case_zip, name)
+
+    return root.join(case_id)
+
+
+def save_numpy_as_niigz(
+        arr: np.ndarray,
+        destination: str,
+        spacing: Optional[Sequence[float]] = None
+):
+    '''
+    :param spacing: (z, y, x) spacing of arr, 1 on axes whose spacing is
+        None, 0 or not finite, e.g. the thickness of a single slice
+    '''
     sitk_image = sitk.GetImageFromArray(arr)
+    if spacing is not None:
+        ### SimpleITK does not support zero-valued spacing
+        sitk_image.SetSpacing([
+            abs(float(s)) if s is not None and np.isfinite(s) and s != 0
+            else 1.
+            for s in reversed(spacing)])
     sitk.WriteImage(sitk_image, destination)
 
 
-def read_segmentation(path: str) -> Optional[np.ndarray]:
-    dicom_list = read_dicom_list(path)
-    if dicom_list:
-        segmentation, = parse_dicom_list(dicom_list, ['pixel_array'])
-        return segmentation
-    else:
-        return None
+def encode_sparse_labels(labels: np.ndarray) -> Dict[str, np.ndarray]:
+    '''
+    Sparse representation of a label volume: the bounding box of its
+    non-zero voxels and the runs of equal labels within the box, in C order
+    :return: {'shape', 'bbox': (ndim, 2) [start, stop), 'values', 'lengths'}
+    '''
+    shape = np.array(labels.shape, np.int64)
+    bbox = np.zeros((labels.ndim, 2), np.int64)
+    for axis in range(labels.ndim):
+        other_axes = tuple(i for i in range(labels.ndim) if i != axis)
+        nonzero = np.flatnonzero(np.any(labels, axis=other_axes))
+        if len(nonzero) == 0:
+            return {
+                'shape': shape,
+                'bbox': bbox,
+                'values': np.zeros(0, labels.dtype),
+                'lengths': np.zeros(0, np.uint32)}
+        bbox[axis] = nonzero[0], nonzero[-1] + 1
 
+    flat = labels[tuple(slice(*extent) for extent in bbox)].ravel()
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(flat)) + 1))
+    lengths = np.diff(np.append(starts, len(flat)))
+    return {
+        'shape': shape,
+        'bbox': bbox,
+        'values': flat[starts],
+        'lengths': lengths.astype(np.uint32)}
 
-def read_liver_annotation(path: str) -> Optional[np.ndarray]:
-    liver = read_segmentation(osp.join(path, 'liver'))
-    if liver is not None:
-        liver = liver.astype(np.int8)
-        liver = np.clip(liver, 0, 1)
-        
-    return liver
 
+def decode_sparse_labels(sparse: Dict[str, np.ndarray]) -> np.ndarray:
+    labels = np.zeros(tuple(sparse['shape']), sparse['values'].dtype)
+    bbox = sparse['bbox']
+    if len(sparse['values']):
+        labels[tuple(slice(*extent) for extent in bbox)] = np.repeat(
+            sparse['values'], sparse['lengths']
+        ).reshape(tuple(bbox[:, 1] - bbox[:, 0]))
+    return labels
 
-def read_spleen_annotation(path: str) -> Optional[np.ndarray]:
-    spleen = read_segmentation(osp.join(path, 'spleen'))
-    if spleen is not None:
-        spleen = spleen.astype(np.int8)
-        spleen = np.clip(spleen, 0, 1)
 
-    return spleen
+def save_sparse_labels(labels: np.ndarray, destination: str):
+    '''
+    Save a label volume as a .npz of encode_sparse_labels, through a
+    temporary file
+    '''
+    tmp_path = get_tmp_path(destination)
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **encode_sparse_labels(labels))
+    replace_file(tmp_path, destination)
 
 
-def read_organ_annotation(path: str) -> Optional[np.ndarray]:
-    logger = logging.getLogger(__name__)        ### todo:
+def load_sparse_labels(path: str) -> np.ndarray:
+    '''
+    :return: dense label volume saved by save_sparse_labels
+    '''
+    with np.load(path) as sparse:
+        return decode_sparse_labels(dict(sparse))
 
-    liver = read_liver_annotation(path)
-    spleen = read_spleen_annotation(path)
-    ### todo: 看一下下面的逻辑
-    if liver is None:
-        if spleen is None:
-            organ = None
-        else:
-            organ = spleen * 2
-    else:
-        if spleen is None:
-            organ = liver
-        else:
-            if liver.shape != spleen.shape:
-                logger.error(
-                    f'{path}: unconsistent shape of liver and '
-                    'spleen annotations.')
-                return None
-            organ = liver + spleen * 2
-            organ = np.clip(organ, 0, 2)
 
-    return organ
+def read_segmentation(path: PathLike) -> Optional[np.ndarray]:
+    segmentation, = read_dicom_volume(path, ['pixel_array'])
+    return segmentation
 
 
-def read_liver_segments_annotation(path: str) -> Optional[np.ndarray]:
+def compose_labels(
+        path: PathLike,
+        layers: List[Tuple[str, int]],
+        cast: Optional[type] = None,
+        allocate: Optional[Callable] = None
+) -> Optional[np.ndarray]:
+    '''
+    Fuse the masks of several annotations into one int8 label volume in a
+    single pass, slice by slice, so no mask volume is ever held in memory.
+    A voxel takes the label of the last layer whose mask covers it.
+    :param path: annotation directory
+    :param layers: (sub-directory, label) in ascending priority
+    :param cast: dtype masks are cast to before thresholding, None to
+        threshold the decoded values
+    :param allocate: callable(shape, dtype) returning a zero-filled output,
+        np.zeros by default
+    :return: label volume, None if no layer exists or shapes unconsistent
+    '''
     logger = logging.getLogger(__name__)
 
-    liver_segments = [
-        read_segmentation(osp.join(path, str(i)))
-        for i in range(1, 9)]
     shape = None
-    for liver_segment in liver_segments:
-        if liver_segment is not None:
-            shape = liver_segment.shape
-            break
+    layer_series = []
+    for name, label in layers:
+        series = read_dicom_series(join_path(path, name))
+        if not series:
+            continue
+        if shape is None:
+            shape = get_volume_shape(series)
+        elif get_volume_shape(series) != shape:
+            logger.error(
+                f'{path}: unconsistent shape of {name} annotation.')
+            return None
+        layer_series.append((series, label))
     if shape is None:
         return None
-    for i, liver_segment in enumerate(liver_segments):
-        if liver_segment is None:
-            liver_segments[i] = np.zeros(shape)
-        else:
-            if liver_segment.shape != shape:
-                logger.error(
-                    f'{path}: unconsistent shape of liver segments '
-                    'annotations.')
-                return None
-            liver_segments[i] = np.clip(liver_segment, 0, 1) * (i + 1)
-    liver_segments = np.stack(liver_segments, axis=0)
-    liver_segments = np.amax(liver_segments, axis=0)
-    liver_segments = liver_segments.astype(np.int8)
 
-    return liver_segments
+    if allocate is None:
+        labels = np.zeros(shape, np.int8)
+    else:
+        labels = allocate(shape, np.int8)
+
+    def fuse(z: int):
+        label_slice = labels[z]
+        for series, label in layer_series:
+            mask = get_pixel_array(read_dicom(series[z][0]))
+            if cast is not None:
+                mask = mask.astype(cast)
+            label_slice[mask > 0] = label
 
+    for _ in map_slices(fuse, range(shape[0])):
+        pass
 
-def read_vessel_annotation(path: str) -> Optional[np.ndarray]:
-    logger = logging.getLogger(__name__)
-    ### todo 看一下逻辑
-    vessels = [
-        read_segmentation(osp.join(path, vessel))
-        for vessel in ['hv', 'pv', 'ivc', 'nb', 'yw']]
-    shape = None
-    for vessel in vessels:
-        if vessel is not None:
-            shape = vessel.shape
-            break
-    if shape is None:
-        return None
-    for i, vessel in enumerate(vessels):
-        if vessel is None:
-            vessels[i] = np.zeros(shape)
-        else:
-            if vessel.shape != shape:
-                logger.error(
-                    f'{path}: unconsistent shape of vessels annotations.')
-            vessels[i] = np.clip(vessel, 0, 1) * (i + 1)
-    vessels = np.stack(vessels, axis=0)
-    vessels = np.amax(vessels, axis=0)
-    vessels = vessels.astype(np.int8)
+    return labels
 
-    return vessels
 
+def read_liver_annotation(
+        path: PathLike,
+        allocate: Optional[Callable] = None
+) -> Optional[np.ndarray]:
+    return compose_labels(path, [('liver', 1)], np.int8, allocate)
 
-def read_lesion_annotation(path: str) -> Optional[np.ndarray]:
-    logger = logging.getLogger(__name__)
 
-    if not set(os.listdir(path)).isdisjoint(
+def read_spleen_annotation(
+        path: PathLike,
+        allocate: Optional[Callable] = None
+) -> Optional[np.ndarray]:
+    return compose_labels(path, [('spleen', 1)], np.int8, allocate)
+
+
+def read_organ_annotation(
+        path: PathLike,
+        allocate: Optional[Callable] = None
+) -> Optional[np.ndarray]:
+    # spleen takes precedence over liver
+    return compose_labels(
+        path, [('liver', 1), ('spleen', 2)], np.int8, allocate)
+
+
+def read_liver_segments_annotation(
+        path: PathLike,
+        allocate: Optional[Callable] = None
+) -> Optional[np.ndarray]:
+    # segment i is labelled i, higher segments take precedence
+    return compose_labels(
+        path, [(str(i), i) for i in range(1, 9)], None, allocate)
+
+
+def read_vessel_annotation(
+        path: PathLike,
+        allocate: Optional[Callable] = None
+) -> Optional[np.ndarray]:
+    return compose_labels(
+        path,
+        [(vessel, i + 1)
+         for i, vessel in enumerate(['hv', 'pv', 'ivc', 'nb', 'yw'])],
+        None,
+        allocate)
+
+
+def read_lesion_annotation(
+        path: PathLike,
+        allocate: Optional[Callable] = None
+) -> Optional[np.ndarray]:
+    if not set(list_dir(path)).isdisjoint(
             ('fqbz', 'fqbzyw', 'fqbz.zip', 'fqbzyw.zip')):
         return None
 
-    lesion_dir = osp.join(path, 'bz')
-    if osp.isdir(lesion_dir):
-        lesion = read_segmentation(lesion_dir)
-    else:
-        lesion = None
-    qsn_lesion_dir = osp.join(path, 'bzyw')
-    if osp.isdir(qsn_lesion_dir):
-        qsn_lesion = read_segmentation(osp.join(path, 'bzyw'))
-    else:
-        qsn_lesion = None
-
-    if lesion is None:
-        if qsn_lesion is not None:
-            lesion = qsn_lesion.astype(np.int8) * 2
-    else:
-        lesion = lesion.astype(np.int8)
-        if qsn_lesion is not None:
-            qsn_lesion = qsn_lesion.astype(np.int8)
-            if lesion.shape != qsn_lesion.shape:
-                logger.error(
-                    f'{path}: unconsistent shape of lesion and '
-                    'questioned lesion annotation')
-                return None
-            lesion += qsn_lesion * 2
-            lesion = np.clip(lesion, 0, 2)
-
-    return lesion
+    # questioned lesion takes precedence over lesion
+    return compose_labels(
+        path, [('bz', 1), ('bzyw', 2)], np.int8, allocate)
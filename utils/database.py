@@ -1,15 +1,30 @@
 import os.path as osp
+import bisect
+import heapq
 import json
 import datetime
+import sqlite3
+import threading
 from multiprocessing import managers
-from typing import List, Dict, Iterable, Union
+from typing import List, Dict, Iterable, Optional, Union
 
 from utils.dicom_io import *
 
 datetime_format = '%Y%m%d%H%M%S'
+### PRAGMA user_version of a database whose json files are imported
+schema_version = 1
+
+
+study_window = datetime.timedelta(hours=2)
+
+
+def parse_datetime(study_datetime: str) -> datetime.datetime:
+    return datetime.datetime.strptime(study_datetime, datetime_format)
 
 
 class Study:
+    __slots__ = ('datetime_set', 'local_id', '_datetime', '_start')
+
     def __init__(
             self,
             study_datetime: Union[str, Iterable[str]],
@@ -26,18 +41,33 @@ class Study:
             study_datetime = set(study_datetime)
         self.datetime_set = study_datetime
         self.local_id = local_id
+        self._datetime = min(study_datetime) if study_datetime else None
+        self._start = None
+
+    @property
+    def datetime(self) -> str:
+        return self._datetime
 
     @property
-    def datetime(self):
-        return min(self.datetime_set)
+    def start(self) -> 'datetime.datetime':
+        '''
+        earliest scan time, parsed once
+        '''
+        if self._start is None:
+            self._start = parse_datetime(self._datetime)
+        return self._start
 
     def __contains__(self, ref_datetime: str):
-        self_time = datetime.datetime.strptime(self.datetime, datetime_format)
-        ref_datetime = datetime.datetime.strptime(ref_datetime, datetime_format)
-        return abs(self_time - ref_datetime) < datetime.timedelta(hours=2)
+        return abs(self.start - parse_datetime(ref_datetime)) < study_window
 
     def add_datetime(self, study_datetime: str):
+        '''
+        use Patient.add_datetime for studies of a patient to keep its index
+        '''
         self.datetime_set.add(study_datetime)
+        if self._datetime is None or study_datetime < self._datetime:
+            self._datetime = study_datetime
+            self._start = None
 
     def serialize(self):
         return {
@@ -48,11 +78,17 @@ class Study:
 class Patient:
     '''
     A patient, contain some study. bug one patient can be different Patient.
-    one patient's scan is a Patient in a day usually
+    one patient's scan is a Patient in a day usually.
+    Studies are indexed by start time, so finding the study of a scan is
+    a bisect instead of a scan over all studies
     '''
+    __slots__ = ('studies', 'time2local_id', '_starts', '_orders')
+
     def __init__(self, patient_info: List):
         self.studies = []
         self.time2local_id = {}
+        self._starts = None
+        self._orders = None
         for item in patient_info:
             if isinstance(item, dict):
                 study = Study(**item)
@@ -65,62 +101,248 @@ class Patient:
     def get_local_ids(self):
         return [study.local_id for study in self.studies]
 
+    def _build_index(self):
+        # start times are parsed lazily, on the first lookup
+        entries = sorted(
+            (study.start, order) for order, study in enumerate(self.studies))
+        self._starts = [start for start, _ in entries]
+        self._orders = [order for _, order in entries]
+
+    def _index_insert(self, order: int):
+        start = self.studies[order].start
+        i = bisect.bisect_right(self._starts, start)
+        self._starts.insert(i, start)
+        self._orders.insert(i, order)
+
+    def _index_remove(self, order: int, start: datetime.datetime):
+        i = bisect.bisect_left(self._starts, start)
+        while self._orders[i] != order:
+            i += 1
+        del self._starts[i]
+        del self._orders[i]
+
+    def find_study(self, study_datetime: str) -> Optional[Study]:
+        '''
+        Find the first appended study within the time window of a scan,
+        same as checking `study_datetime in study` over self.studies in order
+        '''
+        if self._starts is None:
+            self._build_index()
+        ref_datetime = parse_datetime(study_datetime)
+        lo = bisect.bisect_right(self._starts, ref_datetime - study_window)
+        hi = bisect.bisect_left(self._starts, ref_datetime + study_window)
+        if lo >= hi:
+            return None
+        return self.studies[min(self._orders[lo:hi])]
+
     def append(self, study: Study):
         self.studies.append(study)
         for study_datetime in study.datetime_set:
             self.time2local_id[study_datetime] = study.local_id
+        if self._starts is not None:
+            self._index_insert(len(self.studies) - 1)
+
+    def add_datetime(self, study: Study, study_datetime: str):
+        if self._starts is None or study_datetime >= study.datetime:
+            study.add_datetime(study_datetime)
+        else:
+            order = self.studies.index(study)
+            self._index_remove(order, study.start)
+            study.add_datetime(study_datetime)
+            self._index_insert(order)
+        self.time2local_id[study_datetime] = study.local_id
 
     def serialize(self):
         return [study.serialize() for study in self.studies]
 
 
+class LocalIdAllocator:
+    '''
+    Allocate the lowest free local id of a MVD, same as probing PA-XX-0000,
+    PA-XX-0001, ... but in logarithmic time. Keeps a high-water mark above
+    which every number is free and a heap of free intervals below it
+    '''
+    __slots__ = ('prefix', 'high_water', 'gaps', 'taken')
+
+    def __init__(self, mvd: str, local_ids: Iterable[str] = ()):
+        self.prefix = f'PA-{int(mvd[3:]):0>2}-'
+        self.taken = set()
+        for local_id in local_ids:
+            number = self.parse(local_id)
+            if number is not None:
+                self.taken.add(number)
+
+        self.high_water = 0
+        self.gaps = []
+        for number in sorted(self.taken):
+            if number > self.high_water:
+                self.gaps.append((self.high_water, number))
+            self.high_water = number + 1
+
+    def parse(self, local_id: str) -> Optional[int]:
+        '''
+        number of a local id, None if it is not the form PA-XX-0000
+        allocated by this mvd
+        '''
+        suffix = local_id[len(self.prefix):]
+        if not local_id.startswith(self.prefix) or not suffix.isdigit():
+            return None
+        number = int(suffix)
+        if self.prefix + f'{number:0>4}' != local_id:
+            return None
+        return number
+
+    def add(self, local_id: str):
+        number = self.parse(local_id)
+        if number is None:
+            return
+        self.taken.add(number)
+        if number > self.high_water:
+            heapq.heappush(self.gaps, (self.high_water, number))
+        self.high_water = max(self.high_water, number + 1)
+
+    def allocate(self) -> str:
+        while self.gaps:
+            start, end = heapq.heappop(self.gaps)
+            if start + 1 < end:
+                heapq.heappush(self.gaps, (start + 1, end))
+            # numbers added inside a gap are skipped lazily
+            if start not in self.taken:
+                number = start
+                break
+        else:
+            number = self.high_water
+            self.high_water += 1
+        self.taken.add(number)
+
+        return self.prefix + f'{number:0>4}'
+
+
 class PatientDatabase:
     '''
-    database, contain a lot patient
+    database, contain a lot patient. Kept in memory, persisted to sqlite in
+    WAL mode row by row, progress updates are committed in batches
+    :param database_dir: directory of the database, databases/ of the repo
+        by default
+    :param commit_interval: max number of uncommitted progress updates
     '''
-    def __init__(self):
-        os.makedirs(osp.join('/'.join(__file__.split('/')[:-2]), 'databases'),exist_ok=True)
-        self.database_dir = osp.join(
-            '/'.join(__file__.split('/')[:-2]), 'databases')
+    def __init__(
+            self,
+            database_dir: Optional[str] = None,
+            commit_interval: int = 64
+    ):
+        if database_dir is None:
+            database_dir = osp.join(
+                '/'.join(__file__.split('/')[:-2]), 'databases')
+        os.makedirs(database_dir, exist_ok=True)
+        self.database_dir = database_dir
         self.patient_infos_path = osp.join(
             self.database_dir, 'patient_infos.json')
-        if osp.isfile(self.patient_infos_path):
-            patient_infos = json.load(open(self.patient_infos_path))
-        else:
-            patient_infos = {}
+        self.case_progress_path = osp.join(
+            self.database_dir, 'case_progress.json')
+        self.sqlite_path = osp.join(self.database_dir, 'database.sqlite')
+        self.commit_interval = commit_interval
+        self.pending = 0
+
+        # accessed by one thread at a time, see SynchronizedPatientDatabase
+        self.connection = sqlite3.connect(
+            self.sqlite_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS studies (
+                patient_id TEXT NOT NULL,
+                local_id TEXT NOT NULL,
+                study_datetime TEXT NOT NULL,
+                PRIMARY KEY (patient_id, local_id, study_datetime));
+            CREATE TABLE IF NOT EXISTS case_progress (
+                case_id TEXT PRIMARY KEY,
+                local_id TEXT,
+                status TEXT,
+                latest_modification_datetime TEXT);
+            CREATE TABLE IF NOT EXISTS case_manifest (
+                case_id TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                fingerprint TEXT,
+                outputs TEXT,
+                PRIMARY KEY (case_id, stage));
+        ''')
+        ### set with the import, a failed import is done again next time
+        version, = self.connection.execute('PRAGMA user_version').fetchone()
+        if version < schema_version:
+            self.migrate_json()
+
+        patient_infos = {}
+        for patient_id, local_id, study_datetime in self.connection.execute(
+                'SELECT patient_id, local_id, study_datetime '
+                'FROM studies ORDER BY rowid'):
+            studies = patient_infos.setdefault(patient_id, {})
+            studies.setdefault(local_id, []).append(study_datetime)
 
         self.patients = {}
         self.mvds = {}
-        for patient_id, patient_info in patient_infos.items():
-            patient = Patient(patient_info)
+        for patient_id, studies in patient_infos.items():
+            patient = Patient([
+                Study(study_datetime, local_id)
+                for local_id, study_datetime in studies.items()])
             self.patients[patient_id] = patient
             for local_id in patient.get_local_ids():
                 mvd = 'MVD' + str(int(local_id.split('-')[1]))
                 local_id_set = self.mvds.setdefault(mvd, set())
                 local_id_set.add(local_id)
-
-        self.case_progress_path = osp.join(
-            self.database_dir, 'case_progress.json')
+        self.allocators = {
+            mvd: LocalIdAllocator(mvd, local_id_set)
+            for mvd, local_id_set in self.mvds.items()}
+
+        self.case_progress = {}
+        for case_id, local_id, status, modification_datetime in \
+                self.connection.execute(
+                    'SELECT case_id, local_id, status, '
+                    'latest_modification_datetime '
+                    'FROM case_progress ORDER BY rowid'):
+            self.case_progress[case_id] = {
+                'LocalID': local_id,
+                'Status': status,
+                'LatestModificationDatetime': modification_datetime}
+
+    def migrate_json(self):
+        '''
+        Import patient_infos.json and case_progress.json, in the transaction
+        setting the schema version. Rows already in the database are kept
+        '''
+        if osp.isfile(self.patient_infos_path):
+            patient_infos = json.load(open(self.patient_infos_path))
+        else:
+            patient_infos = {}
         if osp.isfile(self.case_progress_path):
-            self.case_progress = json.load(open(self.case_progress_path))
+            case_progress = json.load(open(self.case_progress_path))
         else:
-            self.case_progress = {}
-
-    def asynchronize(self, manager: managers.SyncManager):
-        self.case_progress = manager.dict(self.case_progress)
+            case_progress = {}
+
+        with self.connection:
+            self.connection.execute('BEGIN')
+            for patient_id, patient_info in patient_infos.items():
+                for study in Patient(patient_info).studies:
+                    self.insert_study_rows(
+                        patient_id, study.local_id, study.datetime_set)
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO case_progress (local_id, status, '
+                'latest_modification_datetime, case_id) VALUES (?, ?, ?, ?)',
+                [(progress['LocalID'], progress['Status'],
+                  progress['LatestModificationDatetime'], case_id)
+                 for case_id, progress in case_progress.items()])
+            self.connection.execute(f'PRAGMA user_version = {schema_version}')
+
+    def get_allocator(self, mvd: str) -> LocalIdAllocator:
+        allocator = self.allocators.get(mvd, None)
+        if allocator is None:
+            allocator = LocalIdAllocator(mvd, self.mvds.setdefault(mvd, set()))
+            self.allocators[mvd] = allocator
+        return allocator
 
     def register_local_id(self, mvd: str):
-        local_id_set = self.mvds.setdefault(mvd, set())
-        mvd_id = int(mvd[3:])
-        local_id_prefix = f'PA-{mvd_id:0>2}-'
-        i = 0
-        while True:
-            local_id = local_id_prefix + f'{i:0>4}'
-            if local_id in local_id_set:
-                i += 1
-            else:
-                break
-        local_id_set.add(local_id)
+        local_id = self.get_allocator(mvd).allocate()
+        self.mvds.setdefault(mvd, set()).add(local_id)
 
         return local_id
 
@@ -133,7 +355,8 @@ class PatientDatabase:
         local_id = self.register_local_id(mvd)
         study = Study(study_datetime, local_id)
         self.patients[patient_id].append(study)
-        self.save_patient_infos()
+        self.insert_study_rows(patient_id, local_id, [study_datetime])
+        self.commit()
 
         return local_id
 
@@ -146,7 +369,8 @@ class PatientDatabase:
         local_id = self.register_local_id(mvd)
         study = Study(study_datetime, local_id)
         self.patients[patient_id] = Patient([study])
-        self.save_patient_infos()
+        self.insert_study_rows(patient_id, local_id, [study_datetime])
+        self.commit()
 
         return local_id
 
@@ -166,11 +390,13 @@ class PatientDatabase:
         if patient is None:
             return self.register_patient(patient_id, study_datetime, mvd)
         else:
-            for study in patient.studies:
-                if study_datetime in study:
-                    study.add_datetime(study_datetime)
-                    self.save_patient_infos()
-                    return study.local_id
+            study = patient.find_study(study_datetime)
+            if study is not None:
+                patient.add_datetime(study, study_datetime)
+                self.insert_study_rows(
+                    patient_id, study.local_id, [study_datetime])
+                self.commit()
+                return study.local_id
             return self.insert_study_to_patient(patient_id, study_datetime, mvd)
 
     def insert_local_id(
@@ -182,9 +408,13 @@ class PatientDatabase:
         mvd = 'MVD' + str(int(local_id.split('-')[1]))
         local_id_set = self.mvds.setdefault(mvd, set())
         local_id_set.add(local_id)
+        self.get_allocator(mvd).add(local_id)
         study = Study(study_datetime, local_id)
         self.patients[patient_id] = Patient([study])
-        self.save_patient_infos()
+        self.connection.execute(
+            'DELETE FROM studies WHERE patient_id = ?', (patient_id, ))
+        self.insert_study_rows(patient_id, local_id, [study_datetime])
+        self.commit()
 
     def update_case_progress(
             self,
@@ -202,16 +432,186 @@ class PatientDatabase:
         if status is not None:
             progress['Status'] = status
 
-        self.save_case_progress()
+        self.write_case_progress(case_id, progress)
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.commit()
+
+    def get_case_manifest(self, case_id: str) -> Dict[str, Dict]:
+        '''
+        :return: stage -> {'fingerprint': inputs fingerprint,
+            'outputs': output paths}, of the stages done for the case
+        '''
+        return {
+            stage: {'fingerprint': fingerprint, 'outputs': json.loads(outputs)}
+            for stage, fingerprint, outputs in self.connection.execute(
+                'SELECT stage, fingerprint, outputs FROM case_manifest '
+                'WHERE case_id = ?', (case_id, ))}
+
+    def update_case_manifest(
+            self,
+            case_id: str,
+            stage: str,
+            fingerprint: str,
+            outputs: List[str] = ()
+    ):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO case_manifest '
+            '(case_id, stage, fingerprint, outputs) VALUES (?, ?, ?, ?)',
+            (case_id, stage, fingerprint, json.dumps(list(outputs))))
+        ### committed right away, it is the journal to resume a run from
+        self.commit()
+
+    def insert_study_rows(
+            self,
+            patient_id: str,
+            local_id: str,
+            study_datetimes: Iterable[str]
+    ):
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO studies '
+            '(patient_id, local_id, study_datetime) VALUES (?, ?, ?)',
+            [(patient_id, local_id, study_datetime)
+             for study_datetime in sorted(study_datetimes)])
+
+    def write_case_progress(self, case_id: str, progress: Dict):
+        row = (
+            progress['LocalID'],
+            progress['Status'],
+            progress['LatestModificationDatetime'],
+            case_id)
+        cursor = self.connection.execute(
+            'UPDATE case_progress SET local_id = ?, status = ?, '
+            'latest_modification_datetime = ? WHERE case_id = ?', row)
+        if cursor.rowcount == 0:
+            self.connection.execute(
+                'INSERT INTO case_progress (local_id, status, '
+                'latest_modification_datetime, case_id) VALUES (?, ?, ?, ?)',
+                row)
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
 
     def save_patient_infos(self):
+        self.commit()
+
+    def save_case_progress(self):
+        self.commit()
+
+    def export_json(self):
+        '''
+        Dump the database to patient_infos.json and case_progress.json
+        '''
         patients = {
             patient_id: patient.serialize()
             for patient_id, patient in self.patients.items()}
-        json.dump(patients, open(self.patient_infos_path, 'w'), indent=2)
+        for obj, path in (
+                (patients, self.patient_infos_path),
+                (dict(self.case_progress), self.case_progress_path)):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(obj, f, indent=2)
+            replace_file(tmp_path, path)
 
-    def save_case_progress(self):
-        json.dump(
-            dict(self.case_progress),
-            open(self.case_progress_path, 'w'),
-            indent=2)
+
+class SynchronizedPatientDatabase(PatientDatabase):
+    '''
+    PatientDatabase whose methods are atomic across threads, served by
+    DatabaseManager where every client connection is a thread
+    '''
+    def __init__(self, *args, **kwargs):
+        self.lock = threading.RLock()
+        super().__init__(*args, **kwargs)
+
+    def get_case_status(self, case_id: str):
+        with self.lock:
+            return super().get_case_status(case_id)
+
+    def get_local_id(self, case_id: str):
+        with self.lock:
+            return super().get_local_id(case_id)
+
+    def get_local_id_by_meta_info(
+            self,
+            patient_id: str,
+            study_datetime: str,
+            mvd: str
+    ) -> str:
+        with self.lock:
+            return super().get_local_id_by_meta_info(
+                patient_id, study_datetime, mvd)
+
+    def insert_local_id(
+            self,
+            patient_id: str,
+            study_datetime: str,
+            local_id: str
+    ):
+        with self.lock:
+            super().insert_local_id(patient_id, study_datetime, local_id)
+
+    def update_case_progress(
+            self,
+            case_id: str,
+            local_id: str = None,
+            status: str = None
+    ):
+        with self.lock:
+            super().update_case_progress(case_id, local_id, status)
+
+    def get_case_manifest(self, case_id: str) -> Dict[str, Dict]:
+        with self.lock:
+            return super().get_case_manifest(case_id)
+
+    def update_case_manifest(
+            self,
+            case_id: str,
+            stage: str,
+            fingerprint: str,
+            outputs: List[str] = ()
+    ):
+        with self.lock:
+            super().update_case_manifest(case_id, stage, fingerprint, outputs)
+
+    def commit(self):
+        with self.lock:
+            super().commit()
+
+    def close(self):
+        with self.lock:
+            super().close()
+
+    def export_json(self):
+        with self.lock:
+            super().export_json()
+
+
+class DatabaseManager(managers.BaseManager):
+    '''
+    Serve a single PatientDatabase from a manager process, the proxies it
+    returns can be passed to pool workers, e.g.
+        manager = DatabaseManager()
+        manager.start()
+        database = manager.PatientDatabase()
+    '''
+
+
+DatabaseManager.register(
+    'PatientDatabase',
+    SynchronizedPatientDatabase,
+    exposed=(
+        'get_case_status',
+        'get_local_id',
+        'get_local_id_by_meta_info',
+        'insert_local_id',
+        'update_case_progress',
+        'get_case_manifest',
+        'update_case_manifest',
+        'commit',
+        'close',
+        'export_json'))
@@ -0,0 +1,259 @@
+import os
+import os.path as osp
+import re
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, \
+    NamedTuple, Optional, Union
+
+import numpy as np
+
+from utils.volume_io import ChunkedVolume, volume_formats, load_volume
+
+### slices-<case id>_ori_<stage><extension of a volume format>
+volume_pattern = re.compile(
+    r'^slices-(?P<case_id>.+)_ori_(?P<stage>[a-z_]+)(?P<extension>' +
+    '|'.join(
+        re.escape(extension)
+        for extension in sorted(volume_formats.values(), key=len,
+                                reverse=True)) +
+    r')$')
+
+Volume = Union[np.ndarray, ChunkedVolume]
+
+
+class ByteLRUCache:
+    '''
+    Least recently used arrays, up to a number of bytes. Arrays are handed
+    out as read-only views, so no caller can change them for the others
+    :param max_bytes: budget of the arrays kept, 0 to keep none
+    '''
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items: 'OrderedDict[Hashable, np.ndarray]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.items
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self.items.get(key, None)
+        if item is None:
+            return default
+        self.items.move_to_end(key)
+        item = item.view()
+        item.flags.writeable = False
+        return item
+
+    def __setitem__(self, key: Hashable, item: np.ndarray):
+        if key in self.items:
+            self.bytes -= self.items.pop(key).nbytes
+        if item.nbytes > self.max_bytes:
+            return
+        self.items[key] = item
+        self.bytes += item.nbytes
+        while self.bytes > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.bytes -= evicted.nbytes
+
+    def clear(self):
+        self.items.clear()
+        self.bytes = 0
+
+
+class OutputCase(NamedTuple):
+    local_id: str
+    case_id: str
+    category: Optional[str]
+    group: Optional[int]
+    spacing: Optional[List[float]]
+    datetime: Optional[str]
+    slices_dir: Optional[str]
+    # stage -> path of its volume
+    volumes: Dict[str, str]
+
+
+def index_output_dir(output_dir: str) -> List[OutputCase]:
+    '''
+    Cases of an output tree of run.py, from the seq_properties.json and the
+    segmentation directory of each patient
+    '''
+    cases = []
+    for entry in sorted(os.scandir(output_dir), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+        local_id = entry.name
+        seq_properties_path = osp.join(entry.path, 'seq_properties.json')
+        if osp.isfile(seq_properties_path):
+            with open(seq_properties_path) as f:
+                seq_properties = json.load(f)
+        else:
+            seq_properties = {}
+
+        volumes = {}
+        seg_dir = osp.join(entry.path, 'segmentation')
+        if osp.isdir(seg_dir):
+            for file in os.listdir(seg_dir):
+                match = volume_pattern.match(file)
+                if match is not None:
+                    volumes.setdefault(match['case_id'], {})[
+                        match['stage']] = osp.join(seg_dir, file)
+        if not seq_properties and not volumes:
+            continue
+
+        case_ids = {
+            rpath.split('/', 1)[1] for rpath in seq_properties}
+        for case_id in sorted(case_ids.union(volumes)):
+            case_info = seq_properties.get('slices/' + case_id, {})
+            slices_dir = osp.join(entry.path, 'slices', case_id)
+            cases.append(OutputCase(
+                local_id,
+                case_id,
+                case_info.get('category', None),
+                case_info.get('group', None),
+                case_info.get('spacing', None),
+                case_info.get('datetime', None),
+                slices_dir if osp.isdir(slices_dir) else None,
+                volumes.get(case_id, {})))
+    return cases
+
+
+class RearangedDataset:
+    '''
+    Cases of an output tree of run.py, indexed once. Volumes are opened
+    lazily: .npy memory-mapped, .zvol chunk by chunk, the other formats
+    are decoded whole. Decoded arrays and .zvol chunks are kept in an LRU
+    cache with a byte budget, shared by the datasets selected from this one.
+    :param output_dir: --output-dir of run.py
+    :param cache_bytes: budget of the cache of decoded arrays
+    :param max_open: max number of volumes kept open
+    :param cases: cases of the dataset, all cases of output_dir by default
+    '''
+    def __init__(
+            self,
+            output_dir: str,
+            cache_bytes: int = 2 ** 30,
+            max_open: int = 256,
+            cases: Optional[List[OutputCase]] = None,
+            _shared: Optional[Dict] = None
+    ):
+        self.output_dir = output_dir
+        self.cases = index_output_dir(output_dir) if cases is None else cases
+        if _shared is None:
+            _shared = {
+                'cache': ByteLRUCache(cache_bytes),
+                'opened': OrderedDict(),
+                'max_open': max_open}
+        self._shared = _shared
+        self.cache: ByteLRUCache = _shared['cache']
+        self.case_ids = {case.case_id: i for i, case in enumerate(self.cases)}
+
+    def __len__(self) -> int:
+        return len(self.cases)
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i: int) -> Dict:
+        '''
+        :return: the fields of a case and a volume per stage, opened lazily
+        '''
+        case = self.cases[i]
+        item = case._asdict()
+        item.pop('volumes')
+        for stage in case.volumes:
+            item[stage] = self.load(case, stage)
+        return item
+
+    def get_case(self, case_id: str) -> OutputCase:
+        return self.cases[self.case_ids[case_id]]
+
+    def get_local_ids(self) -> List[str]:
+        return sorted({case.local_id for case in self.cases})
+
+    def get_categories(self) -> List[str]:
+        return sorted({
+            case.category for case in self.cases
+            if case.category is not None})
+
+    def select(
+            self,
+            local_ids: Optional[Iterable[str]] = None,
+            case_ids: Optional[Iterable[str]] = None,
+            categories: Optional[Iterable[str]] = None,
+            groups: Optional[Iterable[int]] = None,
+            stages: Iterable[str] = ()
+    ) -> 'RearangedDataset':
+        '''
+        :param stages: stages every case selected has a volume of
+        :return: dataset of the cases matching all the conditions given,
+            sharing the cache of this one
+        '''
+        conditions = [
+            ('local_id', local_ids), ('case_id', case_ids),
+            ('category', categories), ('group', groups)]
+        conditions = [
+            (field, set(values)) for field, values in conditions
+            if values is not None]
+        stages = set(stages)
+        cases = [
+            case for case in self.cases
+            if all(getattr(case, field) in values
+                   for field, values in conditions)
+            and stages.issubset(case.volumes)]
+        return RearangedDataset(
+            self.output_dir, cases=cases, _shared=self._shared)
+
+    def load(self, case: Union[OutputCase, str], stage: str) -> Volume:
+        '''
+        :return: volume of a stage of a case, array-like, sliced along z
+            without reading the other slices for .npy and .zvol
+        '''
+        if isinstance(case, str):
+            case = self.get_case(case)
+        path = case.volumes[stage]
+        volume = self.cache.get(path, None)
+        if volume is not None:
+            return volume
+
+        opened = self._shared['opened']
+        volume = opened.get(path, None)
+        if volume is not None:
+            opened.move_to_end(path)
+            return volume
+        volume = load_volume(path, self.cache)
+        if isinstance(volume, (np.memmap, ChunkedVolume)):
+            opened[path] = volume
+            if len(opened) > self._shared['max_open']:
+                _, evicted = opened.popitem(last=False)
+                ### reopened if a caller still reads it
+                if isinstance(evicted, ChunkedVolume):
+                    evicted.close()
+        else:
+            self.cache[path] = volume
+            volume = self.cache.get(path, volume)
+        return volume
+
+    def load_slab(
+            self,
+            case: Union[OutputCase, str],
+            stage: str,
+            start: int,
+            stop: int
+    ) -> np.ndarray:
+        '''
+        :return: z-slices [start, stop) of a volume, as an array
+        '''
+        return np.asarray(self.load(case, stage)[start:stop])
+
+    def close(self):
+        opened = self._shared['opened']
+        for volume in opened.values():
+            if isinstance(volume, ChunkedVolume):
+                volume.close()
+        opened.clear()
+        self.cache.clear()
@@ -1,19 +1,215 @@
+import io
 import os
 import os.path as osp
-from typing import List, Generator, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile
+from typing import Callable, Dict, Iterable, Iterator, List, Generator, \
+    NamedTuple, Optional, Tuple, Union
 
 import pydicom
+from pydicom.pixel_data_handlers.util import pixel_dtype
 import numpy as np
 
 
-def dicom_generator(path: str) -> Generator:
+class ZipMember(NamedTuple):
+    zip_file: ZipFile
+    name: str
+
+    def __str__(self):
+        return f'{self.zip_file.filename}:{self.name}'
+
+    def read(self) -> bytes:
+        return self.zip_file.read(self.name)
+
+    def open(self):
+        return self.zip_file.open(self.name)
+
+
+class ZipDirectory:
+    '''
+    A read-only directory view over zip members, members of nested zips
+    can be mounted under any directory, so nothing is extracted to disk
+    :param members: virtual path -> zip member
+    :param prefix: virtual path of this directory
+    '''
+    def __init__(
+            self,
+            members: Optional[Dict[str, ZipMember]] = None,
+            prefix: str = ''
+    ):
+        self.members = {} if members is None else members
+        self.prefix = prefix.strip('/')
+
+    def __str__(self):
+        return self.prefix
+
+    def _key(self, name: str) -> str:
+        return name if self.prefix == '' else self.prefix + '/' + name
+
+    def add_member(self, zip_file: ZipFile, name: str, destination: str = ''):
+        key = self._key(osp.join(destination, name)).strip('/')
+        self.members[key] = ZipMember(zip_file, name)
+
+    def add_zip(self, zip_file: ZipFile, destination: str = ''):
+        for info in zip_file.infolist():
+            if not info.is_dir():
+                self.add_member(zip_file, info.filename, destination)
+
+    def join(self, *names: str) -> 'ZipDirectory':
+        return ZipDirectory(self.members, self._key('/'.join(names)))
+
+    def walk(self) -> Generator[Tuple[str, ZipMember], None, None]:
+        start = '' if self.prefix == '' else self.prefix + '/'
+        for key, member in self.members.items():
+            if key.startswith(start):
+                yield key, member
+
+    def isdir(self) -> bool:
+        return next(self.walk(), None) is not None
+
+    def close(self):
+        for zip_file in {member.zip_file for member in self.members.values()}:
+            zip_file.close()
+
+    def listdir(self) -> List[str]:
+        start = len(self.prefix) + 1 if self.prefix else 0
+        names = []
+        for key, _ in self.walk():
+            name = key[start:].split('/')[0]
+            if name not in names:
+                names.append(name)
+        return names
+
+
+PathLike = Union[str, ZipDirectory]
+
+# threads used to read and decode the slices of one series, see set_io_threads
+io_threads = 1
+_io_executor = None
+_io_executor_pid = None
+
+header_tags = [
+    (0x0008, 0x0020),  # StudyDate
+    (0x0008, 0x0022),  # AcquisitionDate
+    (0x0008, 0x0030),  # StudyTime
+    (0x0008, 0x0032),  # AcquisitionTime
+    (0x0010, 0x0020),  # PatientID
+    (0x0020, 0x000D),  # StudyInstanceUID
+    (0x0020, 0x000E),  # SeriesInstanceUID
+    (0x0020, 0x0032),  # ImagePositionPatient
+    (0x0020, 0x0037),  # ImageOrientationPatient
+    (0x0028, 0x0030),  # PixelSpacing
+]
+volume_tags = header_tags + [
+    (0x0028, 0x0002),  # SamplesPerPixel
+    (0x0028, 0x0010),  # Rows
+    (0x0028, 0x0011),  # Columns
+    (0x0028, 0x0100),  # BitsAllocated
+    (0x0028, 0x0103),  # PixelRepresentation
+]
+
+### header fields of a slice, missing numbers are nan or 0, strings ''.
+### String fields are widened to the longest value, see get_table_dtype
+header_table_dtype = np.dtype([
+    ('position', np.float64, (3, )),
+    ('orientation', np.float64, (6, )),
+    ('pixel_spacing', np.float64, (2, )),
+    ('rows', np.int32),
+    ('columns', np.int32),
+    ('samples_per_pixel', np.int32),
+    ('dtype', 'U8'),
+    ('patient_id', 'U64'),
+    ('series_instance_uid', 'U64'),
+    ('study_date', 'U8'),
+    ('study_time', 'U6'),
+    ('acquisition_date', 'U8'),
+    ('acquisition_time', 'U6'),
+])
+
+
+class DicomSeries:
+    '''
+    Image slices of a series sorted by location, their header fields in a
+    structured array of header_table_dtype, no dataset is kept
+    :param paths: path or zip member of each slice
+    :param table: header fields of each slice
+    '''
+    def __init__(
+            self,
+            paths: List[Union[str, ZipMember]],
+            table: np.ndarray
+    ):
+        self.paths = paths
+        self.table = table
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __getitem__(self, i: int) -> Tuple[Union[str, ZipMember], np.void]:
+        return self.paths[i], self.table[i]
+
+
+def join_path(path: PathLike, *names: str) -> PathLike:
+    if isinstance(path, ZipDirectory):
+        return path.join(*names)
+    return osp.join(path, *names)
+
+
+def is_dir(path: PathLike) -> bool:
+    if isinstance(path, ZipDirectory):
+        return path.isdir()
+    return osp.isdir(path)
+
+
+def list_dir(path: PathLike) -> List[str]:
+    if isinstance(path, ZipDirectory):
+        return path.listdir()
+    return os.listdir(path)
+
+
+def set_io_threads(threads: int):
+    '''
+    Set the number of threads reading and decoding slices within a series,
+    can be used as the initializer of a process pool
+    '''
+    global io_threads, _io_executor
+    threads = max(1, int(threads))
+    if threads != io_threads and _io_executor is not None:
+        _io_executor.shutdown(wait=False)
+        _io_executor = None
+    io_threads = threads
+
+
+def map_slices(func: Callable, iterable: Iterable) -> Iterator:
+    '''
+    Ordered map over slices, run by the series thread pool if io_threads > 1
+    '''
+    global _io_executor, _io_executor_pid
+    if io_threads <= 1:
+        return map(func, iterable)
+    # an executor inherited through fork has no threads, build a new one
+    if _io_executor is None or _io_executor_pid != os.getpid():
+        _io_executor = ThreadPoolExecutor(io_threads)
+        _io_executor_pid = os.getpid()
+    return _io_executor.map(func, iterable)
+
+
+def dicom_generator(path: PathLike) -> Generator:
+    if isinstance(path, ZipDirectory):
+        for _, member in path.walk():
+            yield member
+        return
     for root, _, files in os.walk(path):
         for file in files:
             yield osp.join(root, file)
 
 
-def read_dicom(path: str) -> Optional[pydicom.dataset.FileDataset]:
+def read_dicom(
+        path: Union[str, ZipMember]
+) -> Optional[pydicom.dataset.FileDataset]:
     try:
+        if isinstance(path, ZipMember):
+            path = io.BytesIO(path.read())
         dicom = pydicom.read_file(path, force=True)
     except Exception:
         dicom = None
@@ -21,7 +217,35 @@ def read_dicom(path: str) -> Optional[pydicom.dataset.FileDataset]:
     return dicom
 
 
-def read_dicom_list(path: str) -> List[pydicom.dataset.FileDataset]:
+def read_dicom_header(
+        path: Union[str, ZipMember],
+        tags: Optional[List] = header_tags
+) -> Optional[pydicom.dataset.FileDataset]:
+    '''
+    Read a dicom without its pixel data
+    :param path: path or zip member of the dicom
+    :param tags: tags to parse, the others are skipped, None for all tags
+    :return: the dataset, None if it can not be read
+    '''
+    try:
+        if isinstance(path, ZipMember):
+            # zip members are streamed, so the pixel data of deflated members
+            # is never decompressed
+            with path.open() as fp:
+                dicom = pydicom.read_file(
+                    fp, force=True, stop_before_pixels=True,
+                    specific_tags=tags)
+        else:
+            dicom = pydicom.read_file(
+                path, force=True, stop_before_pixels=True,
+                specific_tags=tags)
+    except Exception:
+        dicom = None
+
+    return dicom
+
+
+def read_dicom_list(path: PathLike) -> List[pydicom.dataset.FileDataset]:
     dicom_list = []
     for dicom_path in dicom_generator(path):
         dicom = read_dicom(dicom_path)
@@ -31,35 +255,299 @@ def read_dicom_list(path: str) -> List[pydicom.dataset.FileDataset]:
     return dicom_list
 
 
+def read_dicom_header_list(
+        path: PathLike,
+        tags: Optional[List] = header_tags
+) -> List[pydicom.dataset.FileDataset]:
+    dicom_list = []
+    for dicom_path in dicom_generator(path):
+        dicom = read_dicom_header(dicom_path, tags)
+        if dicom is not None:
+            dicom_list.append(dicom)
+
+    return dicom_list
+
+
+def get_number(
+        dicom: pydicom.dataset.FileDataset,
+        tag: Tuple[int, int],
+        size: int
+) -> List[float]:
+    element = dicom.get(tag, None)
+    try:
+        values = [float(value) for value in element.value]
+    except (AttributeError, TypeError, ValueError):
+        return [np.nan] * size
+    return values if len(values) == size else [np.nan] * size
+
+
+def get_header_row(dicom: pydicom.dataset.FileDataset) -> Tuple:
+    '''
+    :return: header fields of a slice, a row of header_table_dtype
+    '''
+    try:
+        dtype = pixel_dtype(dicom).str
+    except Exception:
+        dtype = ''
+    return (
+        get_number(dicom, (0x0020, 0x0032), 3),
+        get_number(dicom, (0x0020, 0x0037), 6),
+        get_number(dicom, (0x0028, 0x0030), 2),
+        int(dicom.get('Rows', 0) or 0),
+        int(dicom.get('Columns', 0) or 0),
+        int(dicom.get('SamplesPerPixel', 1) or 1),
+        dtype,
+        get_patient_id(dicom) or '',
+        get_series_instance_uid(dicom) or '',
+        get_study_date(dicom) or '',
+        get_study_time(dicom) or '',
+        get_acquisition_date(dicom) or '',
+        get_acquisition_time(dicom) or '')
+
+
+def get_table_dtype(rows: List[Tuple]) -> np.dtype:
+    '''
+    :return: header_table_dtype with string fields wide enough for every
+        value of rows, so that none is truncated
+    '''
+    fields = []
+    for i, name in enumerate(header_table_dtype.names):
+        field_dtype = header_table_dtype[name]
+        if field_dtype.kind == 'U':
+            length = max((len(row[i]) for row in rows), default=0)
+            if length > field_dtype.itemsize // 4:
+                field_dtype = np.dtype(f'U{length}')
+        fields.append((name, field_dtype))
+    return np.dtype(fields)
+
+
+def get_header_table(
+        dicom_list: Iterable[pydicom.dataset.FileDataset]
+) -> np.ndarray:
+    rows = [get_header_row(dicom) for dicom in dicom_list]
+    return np.array(rows, get_table_dtype(rows))
+
+
+def get_slice_order(table: np.ndarray) -> np.ndarray:
+    '''
+    :return: indices sorting slices by location, stable, slices without a
+        position last
+    '''
+    return np.argsort(table['position'][:, 2], kind='stable')
+
+
+def check_slice_positions(
+        table: np.ndarray,
+        tolerance: float = 1e-3
+) -> Dict[str, np.ndarray]:
+    '''
+    Check the locations of the slices of a sorted series
+    :param tolerance: max difference of two gaps to be even, in mm
+    :return: {'missing': indices of slices without a position,
+        'duplicate': indices of slices at the location of the slice before,
+        'uneven': indices of slices whose gap to the slice before differs
+        from the median gap}
+    '''
+    locations = table['position'][:, 2]
+    missing = np.flatnonzero(np.isnan(locations))
+    located = np.flatnonzero(~np.isnan(locations))
+    gaps = np.diff(locations[located])
+    duplicate = located[1:][np.abs(gaps) <= tolerance]
+    uneven = np.zeros(0, np.int64)
+    if len(gaps) > len(duplicate):
+        even_gap = np.median(gaps[np.abs(gaps) > tolerance])
+        uneven = located[1:][
+            (np.abs(gaps) > tolerance) &
+            (np.abs(gaps - even_gap) > tolerance)]
+    return {'missing': missing, 'duplicate': duplicate, 'uneven': uneven}
+
+
+def get_series_spacing(table: np.ndarray) -> List[float]:
+    '''
+    :return: [slice thickness, row spacing, column spacing] of a sorted
+        series, the thickness is the mean gap of the located slices, a
+        missing pixel spacing is None
+    '''
+    locations = table['position'][:, 2]
+    locations = locations[~np.isnan(locations)]
+    if len(locations) <= 1:
+        thickness = 0.
+    else:
+        thickness = (locations[-1] - locations[0]) / (len(locations) - 1)
+    return [float(thickness)] + [
+        None if np.isnan(spacing) else float(spacing)
+        for spacing in table['pixel_spacing'][0]]
+
+
+def get_series_datetime(table: np.ndarray) -> Optional[str]:
+    '''
+    :return: acquisition datetime of the first slice
+    '''
+    row = table[0]
+    if row['acquisition_date'] == '' or row['acquisition_time'] == '':
+        return None
+    return str(row['acquisition_date']) + str(row['acquisition_time'])
+
+
+def read_dicom_series(path: PathLike) -> DicomSeries:
+    '''
+    Read headers of all image slices under path into a header table, sorted
+    by slice location, each header is dropped as soon as it is tabulated
+    :param path: directory of the series
+    '''
+    def read_row(dicom_path: Union[str, ZipMember]) -> Optional[Tuple]:
+        header = read_dicom_header(dicom_path, volume_tags)
+        if header is None or 'Rows' not in header:
+            return None
+        return get_header_row(header)
+
+    dicom_paths = list(dicom_generator(path))
+    paths, rows = [], []
+    for dicom_path, row in zip(dicom_paths, map_slices(read_row, dicom_paths)):
+        if row is not None:
+            paths.append(dicom_path)
+            rows.append(row)
+    table = np.array(rows, get_table_dtype(rows))
+    order = get_slice_order(table)
+
+    return DicomSeries([paths[i] for i in order], table[order])
+
+
+def get_volume_shape(series: DicomSeries) -> Tuple[int, ...]:
+    row = series.table[0]
+    shape = (len(series), int(row['rows']), int(row['columns']))
+    if row['samples_per_pixel'] > 1:
+        shape += (int(row['samples_per_pixel']), )
+    return shape
+
+
+def get_volume_dtype(series: DicomSeries) -> np.dtype:
+    '''
+    :return: pixel dtype of the first slice it is known of
+    '''
+    dtypes = series.table['dtype']
+    known = np.flatnonzero(dtypes != '')
+    if len(known) == 0:
+        raise ValueError('Unknown pixel dtype of the series.')
+    return np.dtype(str(dtypes[known[0]]))
+
+
+def build_volume(
+        series: DicomSeries,
+        out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    '''
+    Decode slices of a sorted series one by one into a preallocated volume,
+    each dataset is dropped as soon as its slice is copied
+    '''
+    if out is None:
+        out = np.empty(get_volume_shape(series), get_volume_dtype(series))
+
+    def decode(i: int):
+        out[i] = get_pixel_array(read_dicom(series.paths[i]))
+
+    for _ in map_slices(decode, range(len(series))):
+        pass
+
+    return out
+
+
+def get_tmp_path(path: str) -> str:
+    directory, file = osp.split(path)
+    return osp.join(directory, '.' + file + '.tmp')
+
+
+def replace_file(tmp_path: str, destination: str):
+    '''
+    Move a file written in full to destination, synced to disk first so a
+    crash never leaves destination truncated
+    '''
+    fd = os.open(tmp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, destination)
+
+
+def open_npy_volume(
+        destination: str,
+        shape: Tuple[int, ...],
+        dtype: np.dtype
+) -> np.memmap:
+    '''
+    Memory-mapped .npy, written to a temporary file until close_npy_volume
+    moves it to destination, so destination is never half written
+    '''
+    return np.lib.format.open_memmap(
+        get_tmp_path(destination), mode='w+', dtype=dtype, shape=shape)
+
+
+def close_npy_volume(volume: np.memmap, destination: str):
+    volume.flush()
+    replace_file(get_tmp_path(destination), destination)
+
+
+def save_dicom_volume(series: DicomSeries, destination: str):
+    '''
+    Stream a sorted series into a memory-mapped .npy file slice by slice,
+    so the volume never has to be held in memory
+    '''
+    volume = open_npy_volume(
+        destination, get_volume_shape(series), get_volume_dtype(series))
+    build_volume(series, volume)
+    close_npy_volume(volume, destination)
+
+
+def read_dicom_volume(path: PathLike, key_list: List[str]):
+    series = read_dicom_series(path)
+    if not series:
+        return [None] * len(key_list)
+
+    results = []
+    for key in key_list:
+        if key == 'pixel_array':
+            results.append(build_volume(series))
+        else:
+            results.extend(parse_header_table(series.table, [key]))
+
+    return results
+
+
+def parse_header_table(table: np.ndarray, key_list: List[str]):
+    '''
+    :param table: header table of a sorted series
+    '''
+    results = []
+    for key in key_list:
+        if key == 'spacing':
+            results.append(get_series_spacing(table))
+        elif key == 'series_instance_uid':
+            results.append(str(table[0]['series_instance_uid']) or None)
+        elif key == 'acquisition_datetime':
+            results.append(get_series_datetime(table))
+        else:
+            raise NotImplementedError
+
+    return results
+
+
 def parse_dicom_list(
         dicom_list: List[pydicom.dataset.FileDataset],
         key_list: List[str]
 ):
-    dicom_list.sort(key=get_slice_location)
+    table = get_header_table(dicom_list)
+    order = get_slice_order(table)
+    dicom_list[:] = [dicom_list[i] for i in order]
+    table = table[order]
     results = []
     for key in key_list:
         if key == 'pixel_array':
             results.append(np.stack(
                 [get_pixel_array(dicom) for dicom in dicom_list],
                 axis=0))
-        elif key == 'spacing':
-            spacing_2d = list(map(
-                float, dicom_list[0]['PixelSpacing'].value))
-            if len(dicom_list) == 1:
-                thickness = 0.
-            else:
-                z_range = dicom_list[-1]['ImagePositionPatient'].value[2] - \
-                          dicom_list[0]['ImagePositionPatient'].value[2]
-                thickness = z_range / (len(dicom_list) - 1)
-            results.append([thickness] + spacing_2d)
-        elif key == 'series_instance_uid':
-            results.append(get_series_instance_uid(dicom_list[0]))
-        elif key == 'acquisition_datetime':
-            results.append(
-                get_acquisition_date(dicom_list[0]) +
-                get_acquisition_time(dicom_list[0]))
         else:
-            raise NotImplementedError
+            results.extend(parse_header_table(table, [key]))
 
     return results
 
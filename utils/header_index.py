@@ -0,0 +1,252 @@
+import os
+import os.path as osp
+import argparse
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, \
+    Tuple
+
+import pydicom
+
+from utils.dicom_io import read_dicom_header, get_patient_id, \
+    get_study_instance_uid, get_study_id, get_series_instance_uid, \
+    get_manufacturer, get_series_description, get_series_number, \
+    get_scanning_sequence, get_study_description, get_study_date, \
+    get_study_time, get_acquisition_date, get_slice_location
+
+
+def get_scanning_sequence_text(
+        dicom: pydicom.dataset.FileDataset
+) -> Optional[str]:
+    scanning_sequence = get_scanning_sequence(dicom)
+    if isinstance(scanning_sequence, list):
+        return '\\'.join(scanning_sequence)
+    return scanning_sequence
+
+
+def get_pixel_spacing(
+        dicom: pydicom.dataset.FileDataset,
+        axis: int
+) -> Optional[float]:
+    pixel_spacing = dicom.get((0x0028, 0x0030), None)
+    return None if pixel_spacing is None \
+        else float(pixel_spacing.value[axis])
+
+
+def get_acquisition_time(
+        dicom: pydicom.dataset.FileDataset
+) -> Optional[str]:
+    ### (0008,0032) AcquisitionTime, get_acquisition_time of dicom_io reads
+    ### the study time the datetime of seq_properties.json is built from
+    acquisition_time = dicom.get((0x0008, 0x0032), None)
+    return None if acquisition_time is None \
+        else str(acquisition_time.value[:6])
+
+
+def get_int(tag: Tuple[int, int]) -> Callable:
+    def getter(dicom: pydicom.dataset.FileDataset) -> Optional[int]:
+        element = dicom.get(tag, None)
+        return None if element is None or element.value in (None, '') \
+            else int(element.value)
+    return getter
+
+
+### column, type, getter of the slice header
+index_columns: List[Tuple[str, str, Callable]] = [
+    ('patient_id', 'TEXT', get_patient_id),
+    ('study_instance_uid', 'TEXT', get_study_instance_uid),
+    ('study_id', 'TEXT', get_study_id),
+    ('series_instance_uid', 'TEXT', get_series_instance_uid),
+    ('series_number', 'TEXT', get_series_number),
+    ('series_description', 'TEXT', get_series_description),
+    ('study_description', 'TEXT', get_study_description),
+    ('manufacturer', 'TEXT', get_manufacturer),
+    ('scanning_sequence', 'TEXT', get_scanning_sequence_text),
+    ('study_date', 'TEXT', get_study_date),
+    ('study_time', 'TEXT', get_study_time),
+    ('acquisition_date', 'TEXT', get_acquisition_date),
+    ('acquisition_time', 'TEXT', get_acquisition_time),
+    ('slice_location', 'REAL', get_slice_location),
+    ('rows', 'INTEGER', get_int((0x0028, 0x0010))),
+    ('columns', 'INTEGER', get_int((0x0028, 0x0011))),
+    ('row_spacing', 'REAL', lambda dicom: get_pixel_spacing(dicom, 0)),
+    ('column_spacing', 'REAL', lambda dicom: get_pixel_spacing(dicom, 1)),
+]
+index_tags = [
+    'PatientID', 'StudyInstanceUID', 'StudyID', 'SeriesInstanceUID',
+    'SeriesNumber', 'SeriesDescription', 'StudyDescription', 'Manufacturer',
+    'ScanningSequence', 'StudyDate', 'StudyTime', 'AcquisitionDate',
+    'AcquisitionTime', 'ImagePositionPatient', 'Rows', 'Columns',
+    'PixelSpacing']
+
+
+def parse_slice(path: str) -> Tuple:
+    '''
+    :return: values of index_columns, all None if path is not a dicom
+    '''
+    dicom = read_dicom_header(path, index_tags)
+    values = []
+    for _, _, getter in index_columns:
+        try:
+            values.append(None if dicom is None else getter(dicom))
+        except (AttributeError, IndexError, TypeError, ValueError):
+            values.append(None)
+    return tuple(values)
+
+
+def scan_files(root: str) -> Iterator[Tuple[str, int, int]]:
+    '''
+    :return: (path, size, mtime in ns) of files under root
+    '''
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_files(entry.path)
+        elif entry.is_file():
+            stat = entry.stat()
+            yield entry.path, stat.st_size, stat.st_mtime_ns
+
+
+class HeaderIndex:
+    '''
+    Key header fields of every slice in sqlite, keyed by path, size and
+    mtime, so a slice is only parsed again once it is changed
+    :param index_path: sqlite file, databases/header_index.sqlite of the
+        repo by default
+    :param commit_interval: number of slices parsed between commits
+    '''
+    def __init__(
+            self,
+            index_path: Optional[str] = None,
+            commit_interval: int = 1024
+    ):
+        if index_path is None:
+            index_path = osp.join(
+                '/'.join(__file__.split('/')[:-2]),
+                'databases', 'header_index.sqlite')
+        os.makedirs(osp.dirname(index_path), exist_ok=True)
+        self.index_path = index_path
+        self.commit_interval = commit_interval
+
+        self.connection = sqlite3.connect(index_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        columns = ', '.join(
+            f'{column} {column_type}'
+            for column, column_type, _ in index_columns)
+        self.connection.executescript(f'''
+            CREATE TABLE IF NOT EXISTS slices (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                {columns});
+            CREATE INDEX IF NOT EXISTS slices_patient
+                ON slices (patient_id);
+            CREATE INDEX IF NOT EXISTS slices_series
+                ON slices (series_instance_uid);
+        ''')
+
+    def __enter__(self) -> 'HeaderIndex':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def update(self, root: str, threads: int = 8) -> Tuple[int, int]:
+        '''
+        Parse the slices under root that are new or changed since the last
+        update, forget the removed ones
+        :param threads: threads parsing headers
+        :return: number of slices parsed, number of slices removed
+        '''
+        root = osp.abspath(root).rstrip(os.sep)
+        ### every path under root/, compared as strings
+        prefix_range = (root + os.sep, root + chr(ord(os.sep) + 1))
+        indexed = {
+            path: (size, mtime)
+            for path, size, mtime in self.connection.execute(
+                'SELECT path, size, mtime FROM slices '
+                'WHERE path >= ? AND path < ?',
+                prefix_range)}
+
+        changed = []
+        for path, size, mtime in scan_files(root):
+            if indexed.pop(path, None) != (size, mtime):
+                changed.append((path, size, mtime))
+
+        insert = 'INSERT OR REPLACE INTO slices VALUES ({})'.format(
+            ', '.join('?' * (3 + len(index_columns))))
+        with ThreadPoolExecutor(max(1, threads)) as executor:
+            values = executor.map(
+                parse_slice, [path for path, _, _ in changed])
+            for i, (file, row) in enumerate(zip(changed, values), 1):
+                self.connection.execute(insert, file + row)
+                if i % self.commit_interval == 0:
+                    self.connection.commit()
+        self.connection.executemany(
+            'DELETE FROM slices WHERE path = ?',
+            [(path, ) for path in indexed])
+        self.connection.commit()
+
+        return len(changed), len(indexed)
+
+    def query(self, sql: str, parameters: Sequence = ()) -> List[Dict]:
+        '''
+        :param sql: query on the slices table, e.g.
+            SELECT path FROM slices WHERE manufacturer = ?
+        '''
+        return [
+            dict(row) for row in self.connection.execute(sql, parameters)]
+
+    def get_series(self, patient_id: Optional[str] = None) -> List[Dict]:
+        '''
+        :return: series with their slice count and spacing, of a patient or
+            of all patients
+        '''
+        sql = '''
+            SELECT patient_id, study_instance_uid, series_instance_uid,
+                series_description, manufacturer,
+                MIN(study_date || study_time) AS study_datetime,
+                COUNT(*) AS slice_count,
+                MIN(slice_location) AS min_location,
+                MAX(slice_location) AS max_location,
+                MAX(row_spacing) AS row_spacing,
+                MAX(column_spacing) AS column_spacing
+            FROM slices WHERE series_instance_uid IS NOT NULL {}
+            GROUP BY patient_id, study_instance_uid, series_instance_uid
+            ORDER BY patient_id, study_datetime'''
+        if patient_id is None:
+            return self.query(sql.format(''))
+        return self.query(sql.format('AND patient_id = ?'), (patient_id, ))
+
+    def get_series_slices(self, series_instance_uid: str) -> List[str]:
+        '''
+        :return: paths of the slices of a series, sorted by location
+        '''
+        return [
+            row['path'] for row in self.query(
+                'SELECT path FROM slices WHERE series_instance_uid = ? '
+                'ORDER BY slice_location, path',
+                (series_instance_uid, ))]
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Index the headers of the dicoms under directories.')
+    parser.add_argument('roots', nargs='+', help='Directories to index.')
+    parser.add_argument('--index-path', default=None,
+                        help='Sqlite file of the index.')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Threads parsing headers.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with HeaderIndex(args.index_path) as header_index:
+        for root in args.roots:
+            parsed, removed = header_index.update(root, args.threads)
+            logging.info(
+                f'{root}: {parsed} slices parsed, {removed} removed.')
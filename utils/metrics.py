@@ -0,0 +1,216 @@
+import os
+import os.path as osp
+import json
+import time
+import cProfile
+import logging
+from contextlib import contextmanager
+from typing import Callable, Dict, Generator, List, Optional
+
+import numpy as np
+
+# where records are appended, see init_metrics
+metrics_path = None
+run_id = None
+profile_dir = None
+_profiler = None
+# records being measured in this process, the innermost last
+_stack = []
+
+io_fields = ('read_bytes', 'write_bytes', 'rchar', 'wchar')
+summary_fields = ('wall', 'cpu', 'peak_rss') + io_fields
+percentiles = (50, 90, 99, 100)
+
+
+def init_metrics(
+        path: Optional[str],
+        run: Optional[str] = None,
+        profile: Optional[str] = None
+):
+    '''
+    Set where this process records metrics, can be used as the initializer
+    of a process pool
+    :param path: json lines file, records are appended, None not to record
+    :param run: id of the run, written in every record
+    :param profile: directory to dump cProfile stats of this process in,
+        None not to profile
+    '''
+    global metrics_path, run_id, profile_dir, _profiler
+    metrics_path = path
+    run_id = run
+    profile_dir = profile
+    _profiler = None
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        _profiler = cProfile.Profile()
+
+
+def read_proc(file: str) -> Dict[str, int]:
+    values = {}
+    try:
+        with open(f'/proc/self/{file}') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                value = value.split()
+                if value and value[0].isdigit():
+                    values[key] = int(value[0])
+    except OSError:
+        pass
+    return values
+
+
+def read_rss(field: str = 'VmHWM') -> Optional[int]:
+    '''
+    :param field: VmHWM for the peak, VmRSS for the current resident size
+    :return: bytes, None if /proc is not available
+    '''
+    rss = read_proc('status').get(field, None)
+    return None if rss is None else rss * 1024
+
+
+def reset_peak_rss():
+    '''
+    restart the peak resident size from the current one, linux only
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def write_record(record: Dict):
+    ### one write of a line in append mode, workers do not interleave
+    with open(metrics_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def measure(case_id: str, stage: str, **fields) -> Generator[Dict, None, None]:
+    '''
+    Record wall time, cpu time of the process, bytes read and written and
+    peak resident size of a stage of a case. Stages may be nested, the peak
+    of a stage covers the stages inside it.
+    :param fields: more fields of the record, the record yielded may be
+        updated too
+    '''
+    if metrics_path is None:
+        yield dict(fields)
+        return
+
+    if _stack:
+        peak_rss = read_rss()
+        if peak_rss is not None:
+            _stack[-1]['peak_rss'] = max(
+                _stack[-1]['peak_rss'] or 0, peak_rss)
+    reset_peak_rss()
+    record = {
+        'run': run_id,
+        'case_id': case_id,
+        'stage': stage,
+        'pid': os.getpid(),
+        'start': time.time(),
+        'peak_rss': None}
+    record.update(fields)
+    _stack.append(record)
+    io_start = read_proc('io')
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    except BaseException:
+        record['failed'] = True
+        raise
+    finally:
+        record['wall'] = time.perf_counter() - wall_start
+        record['cpu'] = time.process_time() - cpu_start
+        io_end = read_proc('io')
+        for field in io_fields:
+            if field in io_start and field in io_end:
+                record[field] = io_end[field] - io_start[field]
+        record['peak_rss'] = max(
+            record['peak_rss'] or 0, read_rss() or 0) or None
+        _stack.pop()
+        if _stack and record['peak_rss'] is not None:
+            _stack[-1]['peak_rss'] = max(
+                _stack[-1]['peak_rss'] or 0, record['peak_rss'])
+        write_record(record)
+
+
+def call_measured(case_id: str, stage: str, func: Callable, *args):
+    '''
+    func(*args) as a stage of a case, to submit to a process pool
+    '''
+    with measure(case_id, stage):
+        if _profiler is None:
+            return func(*args)
+        _profiler.enable()
+        try:
+            return func(*args)
+        finally:
+            _profiler.disable()
+            ### stats add up over the tasks of the process
+            _profiler.dump_stats(
+                osp.join(profile_dir, f'worker-{os.getpid()}.prof'))
+
+
+def read_metrics(path: str, run: Optional[str] = None) -> List[Dict]:
+    records = []
+    if not osp.isfile(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if run is None or record.get('run', None) == run:
+                records.append(record)
+    return records
+
+
+def summarize_metrics(records: List[Dict]) -> Dict[str, Dict]:
+    '''
+    :return: stage -> {'count', 'failed', field: {'total', 'p50', 'p90',
+        'p99', 'p100'}}
+    '''
+    stages = {}
+    for record in records:
+        stages.setdefault(record['stage'], []).append(record)
+
+    summary = {}
+    for stage, stage_records in sorted(stages.items()):
+        stage_summary = {
+            'count': len(stage_records),
+            'failed': sum(
+                1 for record in stage_records if record.get('failed'))}
+        for field in summary_fields:
+            values = np.array([
+                record[field] for record in stage_records
+                if record.get(field, None) is not None], np.float64)
+            if len(values) == 0:
+                continue
+            stage_summary[field] = {'total': float(values.sum())}
+            for q, value in zip(
+                    percentiles, np.percentile(values, percentiles)):
+                stage_summary[field][f'p{q}'] = float(value)
+        summary[stage] = stage_summary
+    return summary
+
+
+def log_summary(summary: Dict[str, Dict], logger: logging.Logger):
+    logger.info(
+        f'{"stage":<24}{"count":>7}{"wall p50":>10}{"p90":>9}{"max":>9}'
+        f'{"cpu total":>11}{"read MB":>10}{"write MB":>10}{"rss max MB":>12}')
+    for stage, stage_summary in summary.items():
+        def get(field: str, key: str) -> float:
+            return stage_summary.get(field, {}).get(key, 0)
+
+        mb = 2 ** 20
+        logger.info(
+            f'{stage:<24}{stage_summary["count"]:>7}'
+            f'{get("wall", "p50"):>10.2f}{get("wall", "p90"):>9.2f}'
+            f'{get("wall", "p100"):>9.2f}{get("cpu", "total"):>11.1f}'
+            f'{get("read_bytes", "total") / mb:>10.1f}'
+            f'{get("write_bytes", "total") / mb:>10.1f}'
+            f'{get("peak_rss", "p100") / mb:>12.1f}')
@@ -0,0 +1,111 @@
+import logging
+from collections import deque
+from concurrent.futures import Executor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable
+
+# yielded by the items of Scheduler.run when the next item is not known yet
+not_ready = object()
+
+
+class Scheduler:
+    '''
+    Run items (cases) through stages of executors in completion order. A task
+    is queued to its stage with a callback, the callback runs in the calling
+    thread as soon as the task is done and may queue the next stages.
+    :param executors: stage name -> executor
+    :param limits: stage name -> max number of tasks submitted to the
+        executor at a time, the others wait in the stage queue
+    '''
+    def __init__(
+            self,
+            executors: Dict[str, Executor],
+            limits: Dict[str, int]
+    ):
+        self.executors = executors
+        self.limits = limits
+        self.queues = {stage: deque() for stage in executors}
+        self.counts = {stage: 0 for stage in executors}
+        self.running = {}
+        self.active = 0
+
+    def submit(
+            self,
+            stage: str,
+            callback: Callable[[Future], None],
+            fn: Callable,
+            *args
+    ):
+        self.queues[stage].append((callback, fn, args))
+
+    def release(self):
+        '''
+        mark an item as finished, so another one can be admitted
+        '''
+        self.active -= 1
+
+    def dispatch(self):
+        for stage, queue in self.queues.items():
+            while queue and self.counts[stage] < self.limits[stage]:
+                callback, fn, args = queue.popleft()
+                future = self.executors[stage].submit(fn, *args)
+                self.running[future] = (stage, callback)
+                self.counts[stage] += 1
+
+    def run(
+            self,
+            items: Iterable,
+            start: Callable,
+            max_active: int,
+            poll_interval: float = 0.5
+    ):
+        '''
+        :param items: items to process, consumed lazily. May yield not_ready
+            while the next item is being found, it should then block a
+            little when nothing else runs
+        :param start: called with each admitted item, queues its first tasks
+            and calls release once the item is finished. Callbacks should
+            release their item when they fail, see Pipeline.call_back in
+            run.py
+        :param max_active: max number of items in flight
+        :param poll_interval: seconds between polls of items not ready
+        '''
+        logger = logging.getLogger(__name__)
+
+        items = iter(items)
+        exhausted = False
+        while True:
+            ready = True
+            while not exhausted and ready and self.active < max_active:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                elif item is not_ready:
+                    ready = False
+                else:
+                    self.active += 1
+                    start(item)
+            self.dispatch()
+            if not self.running:
+                if exhausted:
+                    break
+                if self.active >= max_active:
+                    ### nothing left to release them, items would be dropped
+                    raise RuntimeError(
+                        f'{self.active} items in flight without any task '
+                        f'running, they were never released.')
+                continue
+
+            done, _ = wait(
+                list(self.running),
+                timeout=None if ready else poll_interval,
+                return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, callback = self.running.pop(future)
+                self.counts[stage] -= 1
+                try:
+                    callback(future)
+                except Exception:
+                    logger.exception(f'Callback of {stage} task failed.')
+
+        if self.active > 0:
+            logger.error(f'{self.active} items were never released.')
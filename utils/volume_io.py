@@ -0,0 +1,229 @@
+import json
+import lzma
+import os
+import os.path as osp
+import struct
+import zlib
+from typing import BinaryIO, MutableMapping, Optional, Sequence, Tuple, \
+    Union
+
+import numpy as np
+import SimpleITK as sitk
+
+from utils.annotation_io import save_numpy_as_niigz, save_sparse_labels, \
+    load_sparse_labels
+from utils.dicom_io import get_tmp_path, map_slices, open_npy_volume, \
+    close_npy_volume, replace_file
+
+### .zvol: magic, header length (uint32), json header, compressed chunks of
+### `slab` z-slices each, index of (offset, size) of chunks (uint64), index
+### offset (uint64) as the last 8 bytes
+zvol_magic = b'ZVOL0001'
+zvol_codecs = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+volume_formats = {
+    'npy': '.npy',
+    'zvol': '.zvol',
+    'niigz': '.nii.gz',
+    ### label volumes only, see encode_sparse_labels
+    'sparse': '.sparse.npz',
+}
+
+
+def save_chunked_volume(
+        volume: np.ndarray,
+        destination: str,
+        codec: str = 'zlib',
+        slab: int = 1
+):
+    '''
+    Save a volume as .zvol, every slab of z-slices compressed on its own so
+    it can be read without decompressing the others. Chunks are compressed
+    by the series thread pool.
+    :param codec: 'zlib' or 'lzma'
+    :param slab: number of z-slices in a chunk
+    '''
+    compress, _ = zvol_codecs[codec]
+    header = json.dumps({
+        'shape': list(volume.shape),
+        'dtype': volume.dtype.str,
+        'codec': codec,
+        'slab': slab,
+    }).encode()
+
+    def compress_slab(z: int) -> bytes:
+        return compress(np.ascontiguousarray(volume[z:z + slab]).tobytes())
+
+    tmp_path = get_tmp_path(destination)
+    with open(tmp_path, 'wb') as f:
+        f.write(zvol_magic)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        index = []
+        for chunk in map_slices(compress_slab, range(0, len(volume), slab)):
+            index.append((f.tell(), len(chunk)))
+            f.write(chunk)
+        index_offset = f.tell()
+        f.write(np.array(index, '<u8').reshape(-1, 2).tobytes())
+        f.write(struct.pack('<Q', index_offset))
+    replace_file(tmp_path, destination)
+
+
+class ChunkedVolume:
+    '''
+    Reader of a .zvol file, only the chunks of the z-slices read are
+    decompressed. Reading after close opens the file again
+    :param cache: mapping to keep decompressed chunks in, keyed by (path,
+        chunk index), e.g. a cache shared by several volumes
+    '''
+    def __init__(self, path: str, cache: Optional[MutableMapping] = None):
+        self.path = path
+        self.cache = cache
+        self.file: BinaryIO = open(path, 'rb')
+        if self.file.read(len(zvol_magic)) != zvol_magic:
+            self.file.close()
+            raise ValueError(f'{path} is not a .zvol file.')
+        header_size, = struct.unpack('<I', self.file.read(4))
+        header = json.loads(self.file.read(header_size))
+        self.shape: Tuple[int, ...] = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.slab: int = header['slab']
+        _, self.decompress = zvol_codecs[header['codec']]
+
+        self.file.seek(-8, os.SEEK_END)
+        index_offset, = struct.unpack('<Q', self.file.read(8))
+        chunk_count = -(-self.shape[0] // self.slab)
+        self.file.seek(index_offset)
+        self.index = np.frombuffer(
+            self.file.read(16 * chunk_count), '<u8').reshape(-1, 2)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __enter__(self) -> 'ChunkedVolume':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def read_chunk(self, i: int) -> np.ndarray:
+        if self.cache is not None:
+            chunk = self.cache.get((self.path, i), None)
+            if chunk is not None:
+                return chunk
+        ### closed by its owner, e.g. evicted by RearangedDataset
+        if self.file.closed:
+            self.file = open(self.path, 'rb')
+        offset, size = self.index[i]
+        self.file.seek(int(offset))
+        chunk = np.frombuffer(
+            self.decompress(self.file.read(int(size))), self.dtype
+        ).reshape((-1, ) + self.shape[1:])
+        if self.cache is not None:
+            self.cache[(self.path, i)] = chunk
+        return chunk
+
+    def read_slab(self, start: int, stop: int) -> np.ndarray:
+        '''
+        :return: z-slices [start, stop)
+        '''
+        start, stop, _ = slice(start, stop).indices(self.shape[0])
+        if start >= stop:
+            return np.empty((0, ) + self.shape[1:], self.dtype)
+        first = start // self.slab
+        chunks = [
+            self.read_chunk(i)
+            for i in range(first, (stop - 1) // self.slab + 1)]
+        start -= first * self.slab
+        stop -= first * self.slab
+        if len(chunks) == 1:
+            return chunks[0][start:stop]
+        return np.concatenate(chunks)[start:stop]
+
+    def read(self) -> np.ndarray:
+        return self.read_slab(0, self.shape[0])
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key, )
+        z, rest = key[0], key[1:]
+        if isinstance(z, slice) and z.step in (None, 1):
+            start, stop, _ = z.indices(self.shape[0])
+            return self.read_slab(start, stop)[(slice(None), ) + rest]
+        if isinstance(z, (int, np.integer)):
+            if z < 0:
+                z += self.shape[0]
+            if not 0 <= z < self.shape[0]:
+                raise IndexError(f'{z} out of range of {self.shape[0]}.')
+            return self.read_slab(z, z + 1)[(0, ) + rest]
+        return self.read()[key]
+
+
+def load_volume(
+        path: str,
+        cache: Optional[MutableMapping] = None
+) -> Union[np.ndarray, ChunkedVolume]:
+    '''
+    Open a volume saved by preprocess, .npy is memory-mapped and .zvol read
+    chunk by chunk, .nii.gz and .sparse.npz are read whole
+    :param cache: cache of decompressed chunks of .zvol, see ChunkedVolume
+    '''
+    if path.endswith(volume_formats['sparse']):
+        return load_sparse_labels(path)
+    if path.endswith(volume_formats['zvol']):
+        return ChunkedVolume(path, cache)
+    if path.endswith(volume_formats['niigz']):
+        return sitk.GetArrayFromImage(sitk.ReadImage(path))
+    return np.load(path, mmap_mode='r')
+
+
+def open_volume(
+        destination: str,
+        shape: Tuple[int, ...],
+        dtype: np.dtype,
+        volume_format: str = 'npy'
+) -> np.ndarray:
+    '''
+    Zero-filled output of a volume, memory-mapped for .npy, and for .zvol in
+    a scratch .npy compressed slab by slab by close_volume. In memory for
+    the other formats, they are encoded whole
+    '''
+    if volume_format == 'npy':
+        return open_npy_volume(destination, shape, dtype)
+    if volume_format == 'zvol':
+        return open_npy_volume(destination + '.npy', shape, dtype)
+    return np.zeros(shape, dtype)
+
+
+def close_volume(
+        volume: np.ndarray,
+        destination: str,
+        volume_format: str = 'npy',
+        spacing: Optional[Sequence[float]] = None,
+        codec: str = 'zlib',
+        slab: int = 1
+):
+    '''
+    Save a volume opened by open_volume to destination
+    :param spacing: (z, y, x) spacing, for .nii.gz only
+    '''
+    if volume_format == 'npy':
+        close_npy_volume(volume, destination)
+    elif volume_format == 'zvol':
+        save_chunked_volume(volume, destination, codec, slab)
+        os.remove(get_tmp_path(destination + '.npy'))
+    elif volume_format == 'niigz':
+        ### SimpleITK picks the format from the extension
+        directory, file = osp.split(destination)
+        tmp_path = osp.join(directory, '.tmp.' + file)
+        save_numpy_as_niigz(volume, tmp_path, spacing)
+        replace_file(tmp_path, destination)
+    elif volume_format == 'sparse':
+        save_sparse_labels(volume, destination)
+    else:
+        raise ValueError(f'Unknown volume format {volume_format}.')